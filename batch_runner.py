@@ -0,0 +1,240 @@
+import gc
+import os
+import sys
+import copy
+import json
+import time
+import yaml
+import argparse
+import traceback
+import multiprocessing
+import os.path as osp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from nuscenes.utils.splits import create_splits_scenes
+from loader import Loader
+from frame_cache import FrameCache
+from run import main, CONFIG_DIRECTORY
+
+DONE_MARKER = "done.json"  # Written into the output directory of a scene once it is rendered completely
+
+
+def parse_shard(shard):
+    """
+    Parse a shard option of the form i/N, with 0 <= i < N.
+    """
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    
+    except ValueError:
+        raise ValueError(f"Invalid shard: {shard}, expected i/N")
+    
+    if not 0 <= index < count:
+        raise ValueError(f"Invalid shard: {shard}, expected 0 <= i < N")
+    
+    return index, count
+
+
+def select_scenes(nusc, scenes=None, split=None, shard=None):
+    """
+    Names of the scenes to render, in a stable order so every machine computes the same shards.
+    Args:
+        nusc: NuScenes.
+        scenes: List of scene names.
+        split: Split name, e.g. val or mini_val, used when scenes is not given.
+        shard: Optional (index, count), keeping every count-th scene starting at index.
+    Returns:
+        List of scene names.
+    """
+    available_scenes = {record["name"] for record in nusc.scene}
+    
+    if scenes is None:
+        if split is None:
+            raise ValueError("Either scenes or a split is required")
+        
+        scenes = create_splits_scenes()[split]
+    
+    missing_scenes = [scene for scene in scenes if scene not in available_scenes]
+    if missing_scenes:
+        raise ValueError(f"Scenes not in {nusc.version}: {', '.join(missing_scenes)}")
+    
+    scenes = sorted(set(scenes))
+    
+    if shard is not None:
+        index, count = shard
+        scenes = scenes[index::count]
+    
+    return scenes
+
+
+def make_scene_configs(scene, number_of_samples, loader_configs, preprocess_configs, visualizer_configs, output_path):
+    """
+    Configs rendering a whole scene into its own output directory.
+    """
+    scene_loader_configs = copy.deepcopy(loader_configs)
+    scene_loader_configs["scene"] = scene
+    scene_loader_configs["sample_range"] = None
+    scene_loader_configs["nframe"] = number_of_samples
+    
+    scene_preprocess_configs = copy.deepcopy(preprocess_configs)
+    scene_visualizer_configs = copy.deepcopy(visualizer_configs)
+    scene_visualizer_configs["output_path"] = osp.join(output_path, scene)
+    
+    if scene_preprocess_configs.get("profile_path", None) is not None:
+        scene_preprocess_configs["profile_path"] = osp.join(output_path, scene, osp.basename(scene_preprocess_configs["profile_path"]))
+    
+    return scene_loader_configs, scene_preprocess_configs, scene_visualizer_configs
+
+
+def is_scene_done(output_directory, config_hash, nframe):
+    """
+    Whether a scene was rendered completely with the same configs and number of frames.
+    The config hash leaves nframe out, like the frame cache key, so it is compared on its own.
+    """
+    marker_path = osp.join(output_directory, DONE_MARKER)
+    
+    if not osp.exists(marker_path):
+        return False
+    
+    with open(marker_path, "r") as f:
+        marker = json.load(f)
+    
+    return marker.get("config_hash", None) == config_hash and marker.get("nframe", None) == nframe
+
+
+# State of a batch worker process, set by init_worker
+_worker_state = {}
+
+
+def init_worker(nusc, predictions, verbose):
+    # Workers are forked, so the NuScenes index and the predictions are inherited instead of reloaded or pickled
+    _worker_state["nusc"] = nusc
+    _worker_state["predictions"] = predictions
+    _worker_state["verbose"] = verbose
+
+
+def render_scene(scene, loader_configs, preprocess_configs, visualizer_configs):
+    """
+    Render one scene in a worker and write its done marker.
+    Returns:
+        Manifest entry of the scene.
+    """
+    output_directory = visualizer_configs["output_path"]
+    config_hash = FrameCache.hash_configs(loader_configs, preprocess_configs, visualizer_configs)
+    
+    entry = {"scene": scene, "output_path": output_directory, "nframe": loader_configs["nframe"], "pid": os.getpid()}
+    
+    if is_scene_done(output_directory, config_hash, loader_configs["nframe"]):
+        entry.update({"status": "skipped", "seconds": 0.0})
+        return entry
+    
+    os.makedirs(output_directory, exist_ok=True)
+    
+    start = time.perf_counter()
+    try:
+        main(
+            loader_configs=loader_configs,
+            preprocess_configs=preprocess_configs,
+            visualizer_configs=visualizer_configs,
+            verbose=_worker_state["verbose"],
+            nusc=_worker_state["nusc"],
+            predictions=_worker_state["predictions"]
+        )
+    
+    except Exception:
+        entry.update({"status": "failed", "seconds": time.perf_counter() - start, "error": traceback.format_exc()})
+        
+        # main closes its pool, loader and streaming threads on errors, reap whatever a failed stage still left
+        # so the next scene of this worker starts clean
+        for child in multiprocessing.active_children():
+            child.terminate()
+            child.join()
+        
+        gc.collect()
+        return entry
+    
+    entry.update({"status": "done", "seconds": time.perf_counter() - start})
+    
+    # The marker is written last, so an interrupted scene is rendered again on the next run
+    with open(osp.join(output_directory, DONE_MARKER), "w") as f:
+        json.dump({**entry, "config_hash": config_hash}, f, indent=2)
+    
+    return entry
+
+
+def write_manifest(path, entries, arguments):
+    # Write atomically, the manifest is rewritten after every scene
+    with open(path + ".tmp", "w") as f:
+        json.dump({"arguments": arguments, "scenes": entries}, f, indent=2)
+    
+    os.replace(path + ".tmp", path)
+
+
+def run_batch(args):
+    loader_configs = yaml.load(open(args.loader_config_path, "r"), Loader=yaml.FullLoader)
+    preprocess_configs = yaml.load(open(args.preprocess_config_path, "r"), Loader=yaml.FullLoader)
+    visualizer_configs = yaml.load(open(args.visualizer_config_path, "r"), Loader=yaml.FullLoader)
+    
+    output_path = args.output_path or visualizer_configs["output_path"]
+    shard = parse_shard(args.shard) if args.shard is not None else None
+    
+    # Load the NuScenes index once for every scene and worker
+    nusc = Loader.load_nuscenes(loader_configs, verbose=args.verbose)
+    number_of_samples = {record["name"]: record["nbr_samples"] for record in nusc.scene}
+    
+    # Likewise the tracking predictions, which every scene would otherwise read from the whole result file
+    predictions = Loader.load_predictions(loader_configs, verbose=args.verbose) if not loader_configs["is_gt"] else None
+    
+    scenes = select_scenes(nusc, scenes=args.scenes, split=args.split, shard=shard)
+    print(f"Rendering {len(scenes)} scenes with {args.num_workers} workers" + (f" (shard {args.shard})" if shard is not None else ""))
+    
+    os.makedirs(output_path, exist_ok=True)
+    manifest_name = f"manifest_shard{shard[0]}of{shard[1]}.json" if shard is not None else "manifest.json"
+    manifest_path = osp.join(output_path, manifest_name)
+    
+    tasks = [
+        (scene, *make_scene_configs(scene, args.nframe or number_of_samples[scene], loader_configs, preprocess_configs, visualizer_configs, output_path))
+        for scene in scenes
+    ]
+    
+    entries = []
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(
+        max_workers=args.num_workers,
+        mp_context=context,
+        initializer=init_worker,
+        initargs=(nusc, predictions, args.verbose)
+    ) as executor:
+        futures = [executor.submit(render_scene, *task) for task in tasks]
+        
+        for future in as_completed(futures):
+            entry = future.result()
+            entries.append(entry)
+            write_manifest(manifest_path, sorted(entries, key=lambda entry: entry["scene"]), vars(args))
+            
+            print(f"[{len(entries)}/{len(tasks)}] {entry['scene']}: {entry['status']} in {entry['seconds']:.1f}s")
+            if entry["status"] == "failed":
+                print(entry["error"])
+    
+    print(f"Manifest saved at {manifest_path}")
+    
+    return entries
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Render many scenes, sharded across machines and parallel within one")
+    parser.add_argument("--verbose", action="store_true", help="Whether to print debug information")
+    parser.add_argument("--loader_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "loader_configs.yaml"), help="Path to the loader config file")
+    parser.add_argument("--preprocess_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "preprocess_configs.yaml"), help="Path to the preprocess config file")
+    parser.add_argument("--visualizer_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "visualizer_configs.yaml"), help="Path to the visualizer config file")
+    parser.add_argument("--scenes", type=str, nargs="+", default=None, help="Names of the scenes to render")
+    parser.add_argument("--split", type=str, default=None, help="Split to render when no scenes are given, e.g. val or mini_val")
+    parser.add_argument("--shard", type=str, default=None, help="Shard i/N of the scenes to render on this machine")
+    parser.add_argument("--num_workers", type=int, default=1, help="Number of scenes rendered in parallel")
+    parser.add_argument("--nframe", type=int, default=None, help="Number of frames per scene, the whole scene by default")
+    parser.add_argument("--output_path", type=str, default=None, help="Output root, one directory per scene, defaults to the visualizer output path")
+    args = parser.parse_args()
+    
+    entries = run_batch(args)
+    
+    if any(entry["status"] == "failed" for entry in entries):
+        sys.exit(1)
@@ -0,0 +1,344 @@
+import sys
+import json
+import time
+import yaml
+import argparse
+import numpy as np
+import os.path as osp
+from nuscenes.eval.tracking.data_classes import TrackingBox
+from loader import Loader
+from utils import unzip
+from frame import Frame
+from pipeline import preprocess_scenes, create_trajectory, cull_trajectory
+from scene_preprocessor import ScenePreprocessor, VoxelAccumulator, NUMBER_OF_NUSCENES_LABEL_TYPES, ME
+from visualizer import Visualizer
+
+TRACKING_NAMES = ["bicycle", "bus", "car", "motorcycle", "pedestrian", "trailer", "truck"]
+
+
+class SyntheticLoader:
+    """
+    Loader-compatible source of synthetic nuScenes-like windows: LIDAR_TOP sweeps with lidarseg labels,
+    calibrated sensors and tracking boxes. Needs no dataroot.
+    """
+    def __init__(self, nsample, nsample_per_frame, points_per_sweep, boxes_per_sample, seed=0):
+        self.nsample_per_frame = nsample_per_frame
+        rng = np.random.default_rng(seed)
+        
+        self.sample_tokens = [f"sample_{i:06d}" for i in range(nsample)]
+        self.lidar_tokens = [f"lidar_{i:06d}" for i in range(nsample)]
+        
+        # Sweeps: points scattered around the sensor up to 70 m, about 5% unlabeled like lidarseg
+        self.raw_sweeps = []
+        for _ in range(nsample):
+            radius = rng.uniform(2.0, 70.0, points_per_sweep)
+            azimuth = rng.uniform(-np.pi, np.pi, points_per_sweep)
+            points = np.zeros((points_per_sweep, 5), dtype=np.float32)
+            points[:, 0] = radius * np.cos(azimuth)
+            points[:, 1] = radius * np.sin(azimuth)
+            points[:, 2] = rng.normal(-1.5, 0.8, points_per_sweep)
+            points[:, 3] = rng.uniform(0, 255, points_per_sweep)
+            
+            labels = rng.integers(1, NUMBER_OF_NUSCENES_LABEL_TYPES, points_per_sweep).astype(np.uint8)
+            labels[rng.random(points_per_sweep) < 0.05] = 0
+            
+            self.raw_sweeps.append((points, labels))
+        
+        # Filtered like the sweeps Loader reads
+        self.sweeps = [Loader.filter_sweep(points, labels) for points, labels in self.raw_sweeps]
+        
+        # Calibrated sensors, constant over the scene like a real log
+        self.camera_intrinsic = np.array([[1266.4, 0.0, 816.3], [0.0, 1266.4, 491.5], [0.0, 0.0, 1.0]])
+        self.camera_extrinsic = Loader.make_extrinsic_matrix([0.5, -0.5, 0.5, -0.5], [1.7, 0.0, 1.5])
+        self.lidar_extrinsic = Loader.make_extrinsic_matrix([0.0, 0.0, 0.707, 0.707], [0.9, 0.0, 1.8])
+        self.camera_views = {
+            "CAM_FRONT": Loader.make_camera_view(
+                {"rotation": [0.5, -0.5, 0.5, -0.5], "translation": [1.7, 0.0, 1.5], "camera_intrinsic": self.camera_intrinsic},
+                {"rotation": [0.707, 0.0, 0.0, 0.707], "translation": [0.9, 0.0, 1.8]},
+                1600, 900
+            )
+        }
+        
+        # Tracking boxes: the same instances drifting through the scene
+        instance_positions = np.stack([rng.uniform(-50, 50, boxes_per_sample), rng.uniform(-50, 50, boxes_per_sample), np.full(boxes_per_sample, -0.8)], axis=1)
+        instance_velocities = rng.normal(0, 0.5, (boxes_per_sample, 3)) * np.array([1, 1, 0])
+        instance_sizes = rng.uniform([0.6, 0.6, 1.5], [2.5, 12.0, 3.5], (boxes_per_sample, 3))
+        instance_yaws = rng.uniform(-np.pi, np.pi, boxes_per_sample)
+        instance_names = rng.choice(TRACKING_NAMES, boxes_per_sample)
+        
+        self.tracking_boxes = {}
+        for i, sample_token in enumerate(self.sample_tokens):
+            self.tracking_boxes[sample_token] = [
+                TrackingBox(
+                    sample_token=sample_token,
+                    translation=tuple(instance_positions[j] + i * instance_velocities[j]),
+                    size=tuple(instance_sizes[j]),
+                    rotation=(0.0, 0.0, np.sin(instance_yaws[j] / 2), np.cos(instance_yaws[j] / 2)),
+                    tracking_id=f"instance_{j:06d}",
+                    tracking_name=str(instance_names[j]),
+                    tracking_score=-1.0
+                )
+                for j in range(boxes_per_sample)
+            ]
+    
+    def __len__(self):
+        return len(self.sample_tokens) - self.nsample_per_frame + 1
+    
+    def __getitem__(self, idx):
+        if idx >= len(self.sample_tokens):
+            raise IndexError("Index out of range")
+        
+        window = range(idx, min(idx + self.nsample_per_frame, len(self.sample_tokens)))
+        
+        return {
+            "sample_tokens": [self.sample_tokens[i] for i in window],
+            "lidar_tokens": [self.lidar_tokens[i] for i in window],
+            "pcd": [self.sweeps[i][0] for i in window],
+            "labels": [self.sweeps[i][1] for i in window],
+            "camera_intrinsic": [self.camera_intrinsic for _ in window],
+            "camera_extrinsic": [self.camera_extrinsic for _ in window],
+            "lidar_extrinsic": [self.lidar_extrinsic for _ in window],
+            "camera_views": [self.camera_views for _ in window],
+            "tracking_boxes": [self.tracking_boxes[self.sample_tokens[i]] for i in window]
+        }
+    
+    def view(self):
+        return self
+    
+    def close(self):
+        pass
+
+
+class StageTimer:
+    def __init__(self):
+        self.results = {}
+    
+    def time(self, stage, function, units):
+        """
+        Time a stage and record its throughput.
+        Args:
+            stage: Stage name.
+            function: Function running the stage, returns a dict of processed unit counts.
+            units: Unit names to report throughput for, e.g. ["points", "frames"].
+        Returns:
+            Return value of the function.
+        """
+        start = time.perf_counter()
+        counts = function()
+        elapsed = time.perf_counter() - start
+        
+        self.results[stage] = {"seconds": elapsed}
+        for unit in units:
+            self.results[stage][f"{unit}_per_second"] = counts[unit] / elapsed if elapsed > 0 else float("inf")
+        
+        return counts
+    
+    def print_table(self):
+        print(f"{'stage':<28}{'seconds':>10}  throughput")
+        for stage, result in self.results.items():
+            throughput = ", ".join(f"{value:,.0f} {key.replace('_per_second', '')}/s" for key, value in result.items() if key != "seconds")
+            print(f"{stage:<28}{result['seconds']:>10.3f}  {throughput}")
+
+
+def run_benchmark(args):
+    loader = SyntheticLoader(
+        nsample=args.nframe + args.nsample_per_frame - 1,
+        nsample_per_frame=args.nsample_per_frame,
+        points_per_sweep=args.points_per_sweep,
+        boxes_per_sample=args.boxes_per_sample,
+        seed=args.seed
+    )
+    windows = [loader[i] for i in range(args.nframe)]
+    timer = StageTimer()
+    
+    # Loader.filter_sweep on the raw sweeps of every window
+    def filter_windows():
+        for idx, window in enumerate(windows):
+            raw_sweeps = loader.raw_sweeps[idx:idx + len(window["labels"])]
+            window["coords"], window["valid_labels"] = unzip([Loader.filter_sweep(points, labels) for points, labels in raw_sweeps])
+        
+        return {"points": sum(sum(len(raw_sweep[1]) for raw_sweep in loader.raw_sweeps[idx:idx + len(window["labels"])]) for idx, window in enumerate(windows)), "frames": len(windows)}
+    
+    timer.time("filter_sweep", filter_windows, ["points", "frames"])
+    number_of_points = sum(sum(len(label) for label in window["valid_labels"]) for window in windows)
+    
+    # accumulate_voxel, every backend available here
+    backends = ["numpy"] + (["minkowski"] if ME is not None else [])
+    for backend in backends:
+        def accumulate_windows():
+            for window in windows:
+                window["accumulated"] = ScenePreprocessor.accumulate_voxel(window["coords"], window["valid_labels"], args.voxel_size, backend=backend)
+            
+            return {"points": number_of_points, "frames": len(windows)}
+        
+        timer.time(f"accumulate_voxel[{backend}]", accumulate_windows, ["points", "frames"])
+    
+    def accumulate_windows_incrementally():
+        voxel_accumulator = VoxelAccumulator(args.voxel_size)
+        for window in windows:
+            voxel_accumulator.update(window["lidar_tokens"], window["coords"], window["valid_labels"])
+        
+        return {"points": number_of_points, "frames": len(windows)}
+    
+    timer.time("accumulate_voxel[incremental]", accumulate_windows_incrementally, ["points", "frames"])
+    number_of_voxels = sum(len(window["accumulated"][1]) for window in windows)
+    
+    # get_tracking_ids
+    def track_windows():
+        for window in windows:
+            window["tracking"] = ScenePreprocessor.get_tracking_ids(window["accumulated"][0], window["tracking_boxes"], grid_size=args.tracking_grid_size)
+        
+        return {"voxels": number_of_voxels, "frames": len(windows)}
+    
+    timer.time("get_tracking_ids", track_windows, ["voxels", "frames"])
+    
+    # create_trajectory
+    visualizer_configs = {"camera_views": args.camera_views, "BEV_height": 50, "resolution": args.resolution, "renderer": args.renderer}
+    frames = [
+        Frame.from_coords(
+            coord=window["accumulated"][0],
+            label=window["accumulated"][1],
+            voxel_size=args.voxel_size,
+            tracking_ids=window["tracking"][0],
+            tracking_id_table=window["tracking"][1],
+            extrinsic=window["camera_extrinsic"][0],
+            intrinsic=window["camera_intrinsic"][0],
+            sample_tokens=window["sample_tokens"],
+            views=window["camera_views"][0]
+        )
+        for window in windows
+    ]
+    trajectory = []
+    
+    def create_trajectories():
+        trajectory.extend(create_trajectory(frames, visualizer_configs))
+        
+        return {"frames": len(frames)}
+    
+    timer.time("create_trajectory", create_trajectories, ["frames"])
+    
+    # Visualizer.wrapup_scenes
+    visualizer = Visualizer(configs=visualizer_configs)
+    
+    def wrapup_trajectory():
+        visualizer.wrapup_scenes(trajectory, args.voxel_size)
+        
+        return {"voxels": number_of_voxels, "frames": len(trajectory)}
+    
+    timer.time("wrapup_scenes", wrapup_trajectory, ["voxels", "frames"])
+    
+    # cull_trajectory and the wrap up of the culled trajectory
+    visualizer_configs["lod_bands"] = args.lod_bands
+    culled_trajectory = []
+    
+    def cull_trajectories():
+        culled_trajectory.extend(cull_trajectory(trajectory, visualizer_configs))
+        
+        return {"voxels": number_of_voxels, "frames": len(trajectory)}
+    
+    timer.time("cull_trajectory", cull_trajectories, ["voxels", "frames"])
+    
+    def wrapup_culled_trajectory():
+        visualizer.wrapup_scenes(culled_trajectory, args.voxel_size)
+        
+        # Throughput over the voxels left after culling, the ones actually wrapped up
+        return {"voxels": sum(len(next(iter(trajectory_element.values()))) for trajectory_element in culled_trajectory), "frames": len(culled_trajectory)}
+    
+    timer.time("wrapup_scenes[culled]", wrapup_culled_trajectory, ["voxels", "frames"])
+    
+    # Whole preprocessing pipeline as run.main runs it
+    preprocess_configs = {
+        "voxel_size": args.voxel_size,
+        "voxel_backend": args.voxel_backend,
+        "incremental_accumulation": args.incremental_accumulation,
+        "tracking_grid_size": args.tracking_grid_size,
+    }
+    
+    def preprocess_pipeline():
+        for _ in preprocess_scenes(loader, preprocess_configs, 0, args.nframe):
+            pass
+        
+        return {"points": number_of_points, "frames": args.nframe}
+    
+    timer.time("preprocess_scenes", preprocess_pipeline, ["points", "frames"])
+    
+    # Parity of the voxel backends, checked when MinkowskiEngine is available
+    parity = None
+    if ME is not None:
+        parity = True
+        for window in windows[:5]:
+            numpy_coords, numpy_labels = ScenePreprocessor.accumulate_voxel(window["coords"], window["valid_labels"], args.voxel_size, backend="numpy")
+            minkowski_coords, minkowski_labels = ScenePreprocessor.accumulate_voxel(window["coords"], window["valid_labels"], args.voxel_size, backend="minkowski")
+            
+            # The numpy backend returns voxels sorted by (x, y, z) index
+            minkowski_indices = np.round(minkowski_coords / args.voxel_size).astype(np.int64)
+            order = np.lexsort(minkowski_indices.T[::-1])
+            
+            parity &= np.array_equal(np.round(numpy_coords / args.voxel_size).astype(np.int64), minkowski_indices[order])
+            parity &= np.array_equal(numpy_labels, minkowski_labels[order])
+    
+    return timer, parity
+
+
+def check_thresholds(results, thresholds):
+    """
+    Compare throughputs against minimum thresholds.
+    Args:
+        results: Stage -> metric -> value.
+        thresholds: Stage -> metric -> minimum value.
+    Returns:
+        List of failure messages.
+    """
+    failures = []
+    for stage, metrics in thresholds.items():
+        for metric, minimum in metrics.items():
+            if stage not in results or metric not in results[stage]:
+                continue
+            
+            if results[stage][metric] < minimum:
+                failures.append(f"{stage} {metric}: {results[stage][metric]:,.1f} < {minimum:,.1f}")
+    
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the visualization pipeline on a synthetic nuScenes-like scene")
+    parser.add_argument("--nframe", type=int, default=50, help="Number of windows")
+    parser.add_argument("--nsample_per_frame", type=int, default=5, help="Number of sweeps per window")
+    parser.add_argument("--points_per_sweep", type=int, default=34000, help="Number of points per sweep")
+    parser.add_argument("--boxes_per_sample", type=int, default=60, help="Number of tracking boxes per sample")
+    parser.add_argument("--voxel_size", type=float, default=0.2, help="Voxel size")
+    parser.add_argument("--voxel_backend", type=str, default="numpy", help="Voxel backend of the pipeline run")
+    parser.add_argument("--incremental_accumulation", action="store_true", help="Use the incremental accumulator in the pipeline run")
+    parser.add_argument("--tracking_grid_size", type=float, default=2.0, help="Cell size of the tracking id grid index")
+    parser.add_argument("--camera_views", type=str, nargs="+", default=["FPV"], help="Camera views, FPV, BEV or camera channels")
+    parser.add_argument("--resolution", type=int, nargs=2, default=[1920, 1080], help="Render resolution")
+    parser.add_argument("--lod_bands", type=float, nargs=2, action="append", default=None, help="LOD band as distance and scale, repeatable")
+    parser.add_argument("--renderer", type=str, default="window", help="Renderer whose wrap up is benchmarked")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic scene")
+    parser.add_argument("--output_path", type=str, default=None, help="Path to write the results as JSON")
+    parser.add_argument("--check", action="store_true", help="Fail if a throughput is below its regression threshold")
+    parser.add_argument("--threshold_path", type=str, default=osp.join(osp.dirname(osp.abspath(__file__)), "configs", "benchmark_thresholds.yaml"), help="Path to the regression threshold file")
+    args = parser.parse_args()
+    
+    timer, parity = run_benchmark(args)
+    timer.print_table()
+    
+    if parity is not None:
+        print(f"numpy/minkowski voxel backend parity: {'ok' if parity else 'MISMATCH'}")
+    
+    if args.output_path is not None:
+        with open(args.output_path, "w") as f:
+            json.dump({"arguments": vars(args), "results": timer.results, "parity": parity}, f, indent=4)
+    
+    if args.check:
+        thresholds = yaml.load(open(args.threshold_path, "r"), Loader=yaml.FullLoader)
+        failures = check_thresholds(timer.results, thresholds)
+        
+        if parity is False:
+            failures.append("numpy and minkowski voxel backends disagree")
+        
+        for failure in failures:
+            print(f"Regression: {failure}")
+        
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class Frame:
+    """
+    Compact container of one accumulated frame.
+    Voxels are stored as int32 indices relative to an origin instead of float64 coordinates, labels as uint8 and
+    tracking ids as int32 indices into a tracking id table shared by the voxels of the frame (-1 outside every box).
+    World coordinates are only materialized when rendering.
+    views holds the named camera views of the window (e.g. every nuScenes camera channel) the trajectory can render from.
+    voxel_scale is None, or the edge of every voxel in voxels once far voxels are merged into coarser level-of-detail
+    cells, indexed by their minimum corner.
+    """
+    __slots__ = [
+        "voxel_indices", "origin", "voxel_size", "label", "tracking_ids", "tracking_id_table",
+        "extrinsic", "intrinsic", "sample_tokens", "views", "voxel_scale",
+    ]
+    
+    def __init__(self, voxel_indices, origin, voxel_size, label, tracking_ids, tracking_id_table, extrinsic, intrinsic, sample_tokens=(), views=None, voxel_scale=None):
+        self.voxel_indices = voxel_indices
+        self.origin = origin
+        self.voxel_size = voxel_size
+        self.label = label
+        self.tracking_ids = tracking_ids
+        self.tracking_id_table = tracking_id_table
+        self.extrinsic = extrinsic
+        self.intrinsic = intrinsic
+        self.sample_tokens = sample_tokens
+        self.views = views if views is not None else {}
+        self.voxel_scale = voxel_scale
+    
+    @staticmethod
+    def from_coords(coord, label, voxel_size, tracking_ids, tracking_id_table, extrinsic, intrinsic, sample_tokens=(), views=None):
+        """
+        Make a frame from voxel coordinates lying on the voxel grid, i.e. multiples of the voxel size.
+        """
+        voxel_indices = np.round(np.asarray(coord) / voxel_size).astype(np.int64)
+        origin_index = voxel_indices.min(axis=0) if voxel_indices.shape[0] > 0 else np.zeros(3, dtype=np.int64)
+        
+        return Frame(
+            voxel_indices=(voxel_indices - origin_index).astype(np.int32),
+            origin=origin_index * voxel_size,
+            voxel_size=voxel_size,
+            label=np.asarray(label).astype(np.uint8),
+            tracking_ids=np.asarray(tracking_ids, dtype=np.int32),
+            tracking_id_table=tuple(tracking_id_table),
+            extrinsic=np.asarray(extrinsic, dtype=np.float64),
+            intrinsic=np.asarray(intrinsic, dtype=np.float64),
+            sample_tokens=tuple(sample_tokens),
+            views=views
+        )
+    
+    @property
+    def coord(self):
+        """
+        Voxel coordinates as float64, computed on access.
+        """
+        if self.voxel_scale is None:
+            return self.origin + self.voxel_indices * self.voxel_size
+        
+        return self.origin + (self.voxel_indices + (self.voxel_scale[:, None] - 1) / 2) * self.voxel_size
+    
+    @property
+    def voxel_sizes(self):
+        """
+        Edge length of the voxels, a scalar unless they have level-of-detail scales.
+        """
+        if self.voxel_scale is None:
+            return self.voxel_size
+        
+        return self.voxel_scale * self.voxel_size
+    
+    @property
+    def origin_index(self):
+        return np.round(np.asarray(self.origin) / self.voxel_size).astype(np.int64)
+    
+    def __len__(self):
+        return self.label.shape[0]
+    
+    def replace(self, **attributes):
+        """
+        Copy of the frame sharing its arrays, with the given attributes replaced.
+        """
+        frame = Frame(**{name: getattr(self, name) for name in Frame.__slots__})
+        
+        for name, value in attributes.items():
+            setattr(frame, name, value)
+        
+        return frame
@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import os.path as osp
+from frame import Frame
+
+# Config keys that change how fast frames are produced but not their content
+NON_CONTENT_KEYS = [
+    "nframe", "sweep_cache_size", "num_prefetch_workers",
+    "incremental_accumulation", "voxel_backend", "streaming", "queue_size",
+    "num_workers", "chunk_size", "max_pending_chunks", "use_cache", "cache_dir", "profile_path",
+]
+CACHED_ARRAY_KEYS = ["voxel_indices", "label", "tracking_ids", "extrinsic", "intrinsic"]
+CACHE_FORMAT_VERSION = 3  # Bump when the stored frame layout changes
+
+
+class FrameCache:
+    """
+    Persistent cache of preprocessed frames.
+    A cache directory is keyed by a hash of the loader and preprocess configs, and every frame in it by a hash of
+    that key and the sample tokens of its window. Frame arrays are stored as .npy files and loaded memory-mapped.
+    Frames are cached before the view transform, so only visualizer settings can change between cache hits.
+    """
+    def __init__(self, cache_dir, loader_configs, preprocess_configs, verbose=False):
+        self.verbose = verbose
+        self.key = FrameCache.hash_configs(loader_configs, preprocess_configs)
+        self.directory = osp.join(cache_dir, self.key)
+        self.manifest_path = osp.join(self.directory, "manifest.json")
+    
+    @staticmethod
+    def hash_configs(*list_of_configs):
+        content = [CACHE_FORMAT_VERSION] + [{key: value for key, value in configs.items() if key not in NON_CONTENT_KEYS} for configs in list_of_configs]
+        
+        return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+    
+    def frame_key(self, sample_tokens):
+        return hashlib.sha1(json.dumps([self.key, sample_tokens]).encode()).hexdigest()
+    
+    def load_manifest(self):
+        if not osp.exists(self.manifest_path):
+            return None
+        
+        with open(self.manifest_path, "r") as f:
+            return json.load(f)
+    
+    def is_complete(self, nframe):
+        """
+        Whether the first nframe frames are cached, or every frame if the scene has fewer windows.
+        """
+        manifest = self.load_manifest()
+        
+        if manifest is None:
+            return False
+        
+        return len(manifest["frames"]) >= min(nframe, manifest["max_frames"])
+    
+    def load_frames(self, nframe):
+        """
+        Load cached frames, memory-mapped.
+        Yields:
+            Preprocessed frames in frame order.
+        """
+        manifest = self.load_manifest()
+        
+        if self.verbose:
+            print(f"Loading preprocessed frames from {self.directory}")
+        
+        for entry in manifest["frames"][:nframe]:
+            frame_directory = osp.join(self.directory, entry["key"])
+            
+            arrays = {key: np.load(osp.join(frame_directory, f"{key}.npy"), mmap_mode="r") for key in CACHED_ARRAY_KEYS}
+            
+            yield Frame(
+                origin=np.array(entry["origin"]),
+                voxel_size=entry["voxel_size"],
+                tracking_id_table=tuple(entry["tracking_id_table"]),
+                sample_tokens=tuple(entry["sample_tokens"]),
+                views={view: {key: np.array(value) for key, value in camera.items()} for view, camera in entry["views"].items()},
+                **arrays
+            )
+    
+    def write_frames(self, frames, max_frames):
+        """
+        Write frames to the cache while passing them through. The manifest is written once every frame is stored.
+        Args:
+            frames: Preprocessed frames in frame order.
+            max_frames: Number of windows of the scene.
+        Yields:
+            The frames.
+        """
+        if osp.exists(self.directory):
+            shutil.rmtree(self.directory)  # Drop an incomplete or shorter cache
+        
+        os.makedirs(self.directory)
+        
+        entries = []
+        for frame in frames:
+            key = self.frame_key(list(frame.sample_tokens))
+            frame_directory = osp.join(self.directory, key)
+            os.makedirs(frame_directory, exist_ok=True)
+            
+            for array_key in CACHED_ARRAY_KEYS:
+                np.save(osp.join(frame_directory, f"{array_key}.npy"), getattr(frame, array_key))
+            
+            entries.append({
+                "key": key,
+                "sample_tokens": list(frame.sample_tokens),
+                "tracking_id_table": list(frame.tracking_id_table),
+                "origin": np.asarray(frame.origin).tolist(),
+                "voxel_size": frame.voxel_size,
+                "views": {view: {key: np.asarray(value).tolist() for key, value in camera.items()} for view, camera in frame.views.items()},
+            })
+            
+            yield frame
+        
+        # Write the manifest atomically, a cache without one is never read
+        with open(self.manifest_path + ".tmp", "w") as f:
+            json.dump({"frames": entries, "max_frames": max_frames}, f)
+        
+        os.replace(self.manifest_path + ".tmp", self.manifest_path)
@@ -1,81 +1,221 @@
+import copy
 import json
+import threading
 import numpy as np
 import os.path as osp
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from nuscenes import NuScenes
+from nuscenes.eval.common.data_classes import EvalBoxes
 from nuscenes.eval.common.loaders import load_prediction, load_gt
 from nuscenes.eval.tracking.data_classes import TrackingConfig, TrackingBox
-from nuscenes.utils.data_classes import LidarSegPointCloud
+from nuscenes.eval.tracking.utils import category_to_tracking_name
+from nuscenes.utils.geometry_utils import transform_matrix
+from pyquaternion import Quaternion
 from utils import convert_quaternion_to_rotation_matrix
+from profiler import get_profiler
+
+CAMERA_CHANNELS = ["CAM_FRONT", "CAM_FRONT_RIGHT", "CAM_BACK_RIGHT", "CAM_BACK", "CAM_BACK_LEFT", "CAM_FRONT_LEFT"]
 
 class Loader:
     # TODO: Make it work when is_gt is False
-    def __init__(self, configs, verbose=False):
+    def __init__(self, configs, nusc=None, verbose=False, window_stride=1, predictions=None):
         self.nsample_per_frame = configs["nsample_per_frame"]
+        self.window_stride = window_stride  # Windows are read every window_stride-th sample, the prefetcher reads ahead accordingly
         self.verbose = verbose
         
+        # Sweep cache: consecutive windows share all but one sweep, so it holds at least a whole window
+        self.sweep_cache = OrderedDict()
+        self.configured_sweep_cache_size = configs.get("sweep_cache_size", None) or 0
+        self.sweep_cache_size = max(self.configured_sweep_cache_size, self.nsample_per_frame)
+        self.sweep_cache_lock = threading.Lock()
+        
+        # Background prefetcher for the first sweep entering the next window, lidar token -> (sample index, future)
+        self.num_prefetch_workers = configs.get("num_prefetch_workers", 1)
+        self.prefetcher = ThreadPoolExecutor(max_workers=self.num_prefetch_workers) if self.num_prefetch_workers > 0 else None
+        self.prefetch_futures = {}
+        
         if self.verbose:
             print("Initializing Loader...")
         
-        # Initialize NuScenes dataset
-        self.nusc = NuScenes(
+        # Initialize NuScenes dataset, unless one is shared by the caller
+        if nusc is None:
+            nusc = Loader.load_nuscenes(configs, verbose=self.verbose)
+        
+        self.nusc = nusc
+        
+        # Load tracking predictions, unless they are shared by the caller
+        if not configs["is_gt"] and predictions is None:
+            predictions = Loader.load_predictions(configs, verbose=self.verbose)
+        
+        # Load Tracking Config
+        with open(configs["tracking_config_path"], "r") as f:
+            self.tracking_configs = TrackingConfig.deserialize(json.load(f))
+        
+        scene = configs.get("scene", None)
+        sample_range = configs.get("sample_range", None)
+        
+        if scene is not None:  # Only resolve the samples of one scene
+            self.sample_tokens = self.get_scene_sample_tokens(scene)
+            
+            if sample_range is not None:
+                self.sample_tokens = self.sample_tokens[sample_range[0]:sample_range[1]]
+            
+            if configs["is_gt"]:  # Load GT data of the selected samples only
+                self.tracking_boxes = self.load_gt_boxes(self.sample_tokens)
+            
+            else:  # Tracking prediction data of the selected samples only
+                tracking_boxes, self.meta = predictions
+                
+                self.tracking_boxes = EvalBoxes()
+                for sample_token in self.sample_tokens:
+                    self.tracking_boxes.add_boxes(sample_token, tracking_boxes.boxes.get(sample_token, []))
+        
+        else:
+            # Load tracking gt data
+            if configs["is_gt"]:  # Load GT data
+                self.tracking_boxes = load_gt(
+                    nusc=self.nusc,
+                    eval_split=configs["eval_split"],
+                    box_cls=TrackingBox,
+                    verbose=self.verbose
+                )
+            
+            else:  # Tracking prediction data
+                self.tracking_boxes, self.meta = predictions
+            
+            self.sample_tokens = [sample_token for sample_token in self.tracking_boxes.boxes.keys()]
+            
+            if sample_range is not None:
+                self.sample_tokens = self.sample_tokens[sample_range[0]:sample_range[1]]
+        
+        # Sample metadata is resolved on first access
+        self.sample_metadata = {}
+
+        if self.verbose:
+            print("Loader initialized.")
+    
+    @staticmethod
+    def load_nuscenes(configs, verbose=False):
+        return NuScenes(
             version=configs["version"], 
             dataroot=configs["dataroot"], 
-            verbose=self.verbose,
+            verbose=verbose,
             map_resolution=configs["map_resolution"]
         )
+    
+    @staticmethod
+    def load_predictions(configs, verbose=False):
+        """
+        Load the tracking predictions of the result file.
+        Returns:
+            Tuple of EvalBoxes of TrackingBox and the meta of the submission.
+        """
+        return load_prediction(
+            result_path=configs["result_path"],
+            max_boxes_per_sample=configs["max_boxes_per_sample"],
+            box_cls=TrackingBox,
+            verbose=verbose
+        )
+    
+    def get_scene_sample_tokens(self, scene):
+        """
+        Get the sample tokens of a scene in temporal order.
+        Args:
+            scene: Scene token or scene name.
+        Returns:
+            List of sample tokens.
+        """
+        scene_records = [record for record in self.nusc.scene if scene in (record["token"], record["name"])]
         
-        # Load Tracking Config
-        with open(configs["tracking_config_path"], "r") as f:
-            self.tracking_configs = TrackingConfig.deserialize(json.load(f))
+        if len(scene_records) == 0:
+            raise ValueError(f"Invalid scene: {scene}")
         
-        # Load tracking gt data
-        if configs["is_gt"]:  # Load GT data
-            self.tracking_boxes = load_gt(
-                nusc=self.nusc,
-                eval_split=configs["eval_split"],
-                box_cls=TrackingBox,
-                verbose=self.verbose
-            )
-        
-        else:  # Load tracking prediction data
-            self.tracking_boxes, self.meta = load_prediction(
-                result_path=configs["result_path"],
-                max_boxes_per_sample=configs["max_boxes_per_sample"],
-                box_cls=TrackingBox,
-                verbose=self.verbose
-            )
-        
-        # Get sample metadata
-        self.sample_tokens = [sample_token for sample_token in self.tracking_boxes.boxes.keys()]
-        self.samples = [self.nusc.get('sample', sample_token) for sample_token in self.sample_tokens]
-        
-        # Get sensor tokens
-        self.lidar_tokens = [sample['data']['LIDAR_TOP'] for sample in self.samples]
-        self.camera_tokens = [sample['data']['CAM_FRONT'] for sample in self.samples]    
+        sample_tokens = []
+        sample_token = scene_records[0]["first_sample_token"]
+        while sample_token != "":
+            sample_tokens.append(sample_token)
+            sample_token = self.nusc.get('sample', sample_token)["next"]
         
-        # Get sensor data
-        self.list_of_lidar_data = [self.nusc.get('sample_data', lidar_token) for lidar_token in self.lidar_tokens]
-        self.list_of_camera_data = [self.nusc.get('sample_data', camera_token) for camera_token in self.camera_tokens]
+        return sample_tokens
+    
+    def load_gt_boxes(self, sample_tokens):
+        """
+        Load GT tracking boxes of the given samples, the same way load_gt does for a whole split.
+        """
+        tracking_boxes = EvalBoxes()
         
-        # Get point cloud and label paths
-        self.list_of_pcd_path = [osp.join(self.nusc.dataroot, self.nusc.get('sample_data', lidar_token)["filename"]) for lidar_token in self.lidar_tokens]
-        self.list_of_label_path = [osp.join(self.nusc.dataroot, self.nusc.get('lidarseg', lidar_token)["filename"]) for lidar_token in self.lidar_tokens]
+        for sample_token in sample_tokens:
+            sample = self.nusc.get('sample', sample_token)
+            
+            sample_boxes = []
+            for annotation_token in sample['anns']:
+                annotation = self.nusc.get('sample_annotation', annotation_token)
+                tracking_name = category_to_tracking_name(annotation['category_name'])
+                
+                if tracking_name is None:  # Not a tracking class
+                    continue
+                
+                sample_boxes.append(
+                    TrackingBox(
+                        sample_token=sample_token,
+                        translation=annotation['translation'],
+                        size=annotation['size'],
+                        rotation=annotation['rotation'],
+                        velocity=self.nusc.box_velocity(annotation['token'])[:2],
+                        num_pts=annotation['num_lidar_pts'] + annotation['num_radar_pts'],
+                        tracking_id=annotation['instance_token'],
+                        tracking_name=tracking_name,
+                        tracking_score=-1.0
+                    )
+                )
+            
+            tracking_boxes.add_boxes(sample_token, sample_boxes)
+        
+        return tracking_boxes
+    
+    def get_sample_metadata(self, idx):
+        """
+        Resolve sensor tokens, file paths and poses of a sample, memoized.
+        Args:
+            idx: Sample index.
+        Returns:
+            Dict of sample metadata.
+        """
+        if idx in self.sample_metadata:
+            return self.sample_metadata[idx]
+        
+        sample = self.nusc.get('sample', self.sample_tokens[idx])
+        
+        # Get sensor data
+        lidar_token = sample['data']['LIDAR_TOP']
+        lidar_data = self.nusc.get('sample_data', lidar_token)
+        camera_data = self.nusc.get('sample_data', sample['data']['CAM_FRONT'])
         
         # Get camera pose and intrinsic
-        self.list_of_camera_calibrated_sensor = [self.nusc.get('calibrated_sensor', camera_data['calibrated_sensor_token']) for camera_data in self.list_of_camera_data]
-        self.list_of_camera_intrinsic = [np.array(camera_calibrated_sensor['camera_intrinsic']) for camera_calibrated_sensor in self.list_of_camera_calibrated_sensor]
-        self.list_of_camera_rotation = [camera_calibrated_sensor['rotation'] for camera_calibrated_sensor in self.list_of_camera_calibrated_sensor]
-        self.list_of_camera_translation = [camera_calibrated_sensor['translation'] for camera_calibrated_sensor in self.list_of_camera_calibrated_sensor]
-        self.list_of_camera_extrinsic = [Loader.make_extrinsic_matrix(rotation, translation) for rotation, translation in zip(self.list_of_camera_rotation, self.list_of_camera_translation)]
+        camera_calibrated_sensor = self.nusc.get('calibrated_sensor', camera_data['calibrated_sensor_token'])
         
         # Get lidar pose
-        self.list_of_lidar_calibrated_sensor = [self.nusc.get('calibrated_sensor', lidar_data['calibrated_sensor_token']) for lidar_data in self.list_of_lidar_data]
-        self.list_of_lidar_rotation = [lidar_calibrated_sensor['rotation'] for lidar_calibrated_sensor in self.list_of_lidar_calibrated_sensor]
-        self.list_of_lidar_translation = [lidar_calibrated_sensor['translation'] for lidar_calibrated_sensor in self.list_of_lidar_calibrated_sensor]
-        self.list_of_lidar_extrinsic = [Loader.make_extrinsic_matrix(rotation, translation) for rotation, translation in zip(self.list_of_lidar_rotation, self.list_of_lidar_translation)]
-
-        if self.verbose:
-            print("Loader initialized.")
+        lidar_calibrated_sensor = self.nusc.get('calibrated_sensor', lidar_data['calibrated_sensor_token'])
+        
+        # Get the pose of every camera relative to the lidar, voxels stay in the lidar frame
+        camera_views = {}
+        for channel in CAMERA_CHANNELS:
+            channel_data = self.nusc.get('sample_data', sample['data'][channel])
+            channel_calibrated_sensor = self.nusc.get('calibrated_sensor', channel_data['calibrated_sensor_token'])
+            camera_views[channel] = Loader.make_camera_view(channel_calibrated_sensor, lidar_calibrated_sensor, channel_data['width'], channel_data['height'])
+        
+        self.sample_metadata[idx] = {
+            "lidar_token": lidar_token,
+            "pcd_path": osp.join(self.nusc.dataroot, lidar_data["filename"]),
+            "label_path": osp.join(self.nusc.dataroot, self.nusc.get('lidarseg', lidar_token)["filename"]),
+            "camera_intrinsic": np.array(camera_calibrated_sensor['camera_intrinsic']),
+            "camera_extrinsic": Loader.make_extrinsic_matrix(camera_calibrated_sensor['rotation'], camera_calibrated_sensor['translation']),
+            "lidar_extrinsic": Loader.make_extrinsic_matrix(lidar_calibrated_sensor['rotation'], lidar_calibrated_sensor['translation']),
+            "camera_views": camera_views,
+        }
+        
+        return self.sample_metadata[idx]
     
     @staticmethod
     def make_extrinsic_matrix(rotation, translation):
@@ -94,19 +234,154 @@ class Loader:
         
         return extrinsic
     
+    @staticmethod
+    def make_camera_view(camera_calibrated_sensor, lidar_calibrated_sensor, width, height):
+        """
+        Make the view of a camera channel looking at points in the lidar frame.
+        Args:
+            camera_calibrated_sensor: Calibrated sensor record of the camera.
+            lidar_calibrated_sensor: Calibrated sensor record of the lidar.
+            width: Image width of the camera.
+            height: Image height of the camera.
+        Returns:
+            Dict of the 4x4 lidar to camera extrinsic, the 3x3 intrinsic and the (width, height) image size.
+        """
+        ego_to_camera = transform_matrix(camera_calibrated_sensor['translation'], Quaternion(camera_calibrated_sensor['rotation']), inverse=True)
+        lidar_to_ego = transform_matrix(lidar_calibrated_sensor['translation'], Quaternion(lidar_calibrated_sensor['rotation']))
+        
+        return {
+            "extrinsic": ego_to_camera @ lidar_to_ego,
+            "intrinsic": np.array(camera_calibrated_sensor['camera_intrinsic']),
+            "image_size": (width, height),
+        }
+    
     @staticmethod
     def load_lidar(pcd_path, label_path):
-        return LidarSegPointCloud(pcd_path, label_path)
+        """
+        Memory-map a lidar sweep and its lidarseg labels without reading them into memory.
+        Returns:
+            Read-only Nx5 float32 points (x, y, z, intensity, ring index) and N uint8 labels.
+        """
+        points = np.memmap(pcd_path, dtype=np.float32, mode="r").reshape(-1, 5)
+        labels = np.memmap(label_path, dtype=np.uint8, mode="r")
+        
+        return points, labels
+    
+    @staticmethod
+    def filter_sweep(points, labels):
+        """
+        Keep the xyz and labels of labeled points, gathering both in a single pass.
+        Args:
+            points: NxC points, xyz first.
+            labels: N labels, 0 being noise/unlabeled.
+        Returns:
+            Mx3 xyz and M labels.
+        """
+        is_labeled = labels != 0
+        
+        return np.asarray(points[is_labeled, :3]), np.asarray(labels[is_labeled])
+    
+    def read_sweep(self, idx):
+        sample_metadata = self.get_sample_metadata(idx)
+        
+        with get_profiler().stage("sweep_load", frame=idx) as counts:
+            points, labels = Loader.load_lidar(sample_metadata["pcd_path"], sample_metadata["label_path"])
+            counts["points_in"] = len(labels)
+            
+            points, labels = Loader.filter_sweep(points, labels)  # Only the labeled xyz are copied out of the page cache
+            counts["points_out"] = len(labels)
+        
+        return points, labels
+    
+    def get_sweep(self, idx):
+        """
+        Get points and labels of a sweep, decoding it at most once while it stays in the cache.
+        Args:
+            idx: Sample index.
+        Returns:
+            Tuple of Nx3 xyz and N uint8 labels of the labeled points.
+        """
+        lidar_token = self.get_sample_metadata(idx)["lidar_token"]
+        
+        with self.sweep_cache_lock:
+            if lidar_token in self.sweep_cache:
+                self.sweep_cache.move_to_end(lidar_token)
+                return self.sweep_cache[lidar_token]
+            
+            _, future = self.prefetch_futures.pop(lidar_token, (None, None))
+        
+        sweep = future.result() if future is not None else self.read_sweep(idx)
+        
+        with self.sweep_cache_lock:
+            self.sweep_cache[lidar_token] = sweep
+            while len(self.sweep_cache) > self.sweep_cache_size:
+                self.sweep_cache.popitem(last=False)  # Evict least recently used sweep
+        
+        return sweep
+    
+    def prefetch_sweep(self, idx):
+        if self.prefetcher is None or idx >= len(self.sample_tokens):
+            return
+        
+        lidar_token = self.get_sample_metadata(idx)["lidar_token"]
+        
+        with self.sweep_cache_lock:
+            if lidar_token in self.sweep_cache or lidar_token in self.prefetch_futures:
+                return
+            
+            self.prefetch_futures[lidar_token] = (idx, self.prefetcher.submit(self.read_sweep, idx))
+    
+    def drop_prefetches_before(self, idx):
+        """
+        Cancel the prefetches of sweeps before a window start, which no later window reads.
+        """
+        with self.sweep_cache_lock:
+            for lidar_token, (prefetch_idx, future) in list(self.prefetch_futures.items()):
+                if prefetch_idx < idx:
+                    future.cancel()
+                    del self.prefetch_futures[lidar_token]
+    
+    def view(self, nsample_per_frame=None, window_stride=None):
+        """
+        Make a loader sharing the dataset and sample metadata of this one, but with its own sweep cache and prefetcher.
+        Use it in forked worker processes, where the prefetcher threads of the parent do not exist,
+        or to read windows of another length or stride, e.g. in a preview.
+        """
+        loader = copy.copy(self)
+        
+        if nsample_per_frame is not None:
+            loader.nsample_per_frame = nsample_per_frame
+            loader.sweep_cache_size = max(self.configured_sweep_cache_size, nsample_per_frame)
+        
+        if window_stride is not None:
+            loader.window_stride = window_stride
+        
+        loader.sweep_cache = OrderedDict()
+        loader.sweep_cache_lock = threading.Lock()
+        loader.prefetcher = ThreadPoolExecutor(max_workers=self.num_prefetch_workers) if self.num_prefetch_workers > 0 else None
+        loader.prefetch_futures = {}
+        
+        return loader
+    
+    def close(self):
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown(wait=False, cancel_futures=True)
+        
+        self.prefetch_futures.clear()
+        self.sweep_cache.clear()
 
     def __len__(self):
-            return len(self.sample_tokens) - self.config["nsample_per_frame"] + 1
+            return len(self.sample_tokens) - self.nsample_per_frame + 1
     
     def __getitem__(self, idx):
+        list_of_sample_token = []
+        list_of_lidar_token = []
         list_of_pcd = []
         list_of_label = []
         list_of_camera_intrinsic = []
         list_of_camera_extrinsic = []
         list_of_lidar_extrinsic = []
+        list_of_camera_views = []
         list_of_tracking_boxes = []
         
         if idx >= len(self.sample_tokens):
@@ -117,25 +392,33 @@ class Loader:
             if idx + i >= len(self.sample_tokens):
                 break
             
-            pcd_path = self.list_of_pcd_path[idx + i]
-            label_path = self.list_of_label_path[idx + i]
-            
-            lidar_seg_pcd = Loader.load_lidar(pcd_path, label_path)
+            sample_metadata = self.get_sample_metadata(idx + i)
+            points, labels = self.get_sweep(idx + i)
             
-            list_of_pcd.append(lidar_seg_pcd.points)
-            list_of_label.append(lidar_seg_pcd.labels)
+            list_of_sample_token.append(self.sample_tokens[idx + i])
+            list_of_lidar_token.append(sample_metadata["lidar_token"])
+            list_of_pcd.append(points)
+            list_of_label.append(labels)
             
-            list_of_camera_intrinsic.append(self.list_of_camera_intrinsic[idx + i])
-            list_of_camera_extrinsic.append(self.list_of_camera_extrinsic[idx + i])
-            list_of_lidar_extrinsic.append(self.list_of_lidar_extrinsic[idx + i])
+            list_of_camera_intrinsic.append(sample_metadata["camera_intrinsic"])
+            list_of_camera_extrinsic.append(sample_metadata["camera_extrinsic"])
+            list_of_lidar_extrinsic.append(sample_metadata["lidar_extrinsic"])
+            list_of_camera_views.append(sample_metadata["camera_views"])
             list_of_tracking_boxes.append(self.tracking_boxes[self.sample_tokens[idx + i]])
+        
+        # Read the first sweep of the next window that this one does not hold while this one is preprocessed
+        self.drop_prefetches_before(idx)
+        self.prefetch_sweep(idx + max(self.window_stride, self.nsample_per_frame))
             
         return {
+            "sample_tokens": list_of_sample_token,
+            "lidar_tokens": list_of_lidar_token,
             "pcd": list_of_pcd,
             "labels": list_of_label,
             "camera_intrinsic": list_of_camera_intrinsic,
             "camera_extrinsic": list_of_camera_extrinsic,
             "lidar_extrinsic": list_of_lidar_extrinsic,
+            "camera_views": list_of_camera_views,
             "tracking_boxes": list_of_tracking_boxes
         }
 
@@ -0,0 +1,290 @@
+import numpy as np
+import multiprocessing
+from collections import deque
+from multiprocessing import shared_memory, resource_tracker
+from tqdm import tqdm
+from frame import Frame
+from profiler import get_profiler, set_profiler, Profiler, NullProfiler
+from scene_preprocessor import ScenePreprocessor, VoxelAccumulator
+
+SHARED_ARRAY_KEYS = ["voxel_indices", "label", "tracking_ids"]  # Frame arrays returned through shared memory
+
+
+def preprocess_scenes(loader, preprocess_configs, start, stop, verbose=False):
+    """
+    Preprocess the windows of the loader one at a time, every window_stride-th window from start.
+    Args:
+        loader: Loader.
+        preprocess_configs: Preprocess configs.
+        start: First window index.
+        stop: Window index to stop before.
+        verbose: Whether to show a progress bar.
+    Yields:
+        Preprocessed frames in frame order, with the camera pose of the window before any view transform.
+    """
+    voxel_size = preprocess_configs["voxel_size"]
+    voxel_backend = preprocess_configs.get("voxel_backend", "minkowski")
+    window_stride = preprocess_configs.get("window_stride", 1)
+    
+    # Slide the accumulation window one sweep at a time instead of re-quantizing every window
+    voxel_accumulator = VoxelAccumulator(voxel_size) if preprocess_configs.get("incremental_accumulation", False) else None
+    profiler = get_profiler()
+
+    with tqdm(range(start, stop, window_stride), disable=not verbose) as pbar:
+        pbar.set_description("Preprocessing scenes")
+        for idx in pbar:
+            scene_data = loader[idx]
+            
+            # Sweeps come filtered from the loader as NumPy xyz and labels, used as they are
+            coords, labels = scene_data["pcd"], scene_data["labels"]
+            
+            with profiler.stage("quantize", frame=idx, points_in=sum(len(label) for label in labels)) as counts:
+                if voxel_accumulator is not None:
+                    accumulated_coords, accumulated_labels = voxel_accumulator.update(scene_data["lidar_tokens"], coords, labels)
+                
+                else:
+                    accumulated_coords, accumulated_labels = ScenePreprocessor.accumulate_voxel(coords, labels, voxel_size, backend=voxel_backend)
+                
+                counts["voxels_out"] = len(accumulated_labels)
+            
+            with profiler.stage("tracking_ids", frame=idx, voxels_in=len(accumulated_labels)) as counts:
+                tracking_boxes = scene_data["tracking_boxes"]
+                tracking_ids, tracking_id_table = ScenePreprocessor.get_tracking_ids(
+                    accumulated_coords, 
+                    tracking_boxes, 
+                    grid_size=preprocess_configs.get("tracking_grid_size", 2.0)
+                )
+                counts["boxes"] = sum(len(boxes) for boxes in tracking_boxes)
+            
+            yield Frame.from_coords(
+                coord=accumulated_coords,
+                label=accumulated_labels,
+                voxel_size=voxel_size,
+                tracking_ids=tracking_ids,
+                tracking_id_table=tracking_id_table,
+                extrinsic=scene_data["camera_extrinsic"][0],
+                intrinsic=scene_data["camera_intrinsic"][0],
+                sample_tokens=scene_data["sample_tokens"],
+                views=scene_data["camera_views"][0]
+            )
+
+
+def get_camera_views(visualizer_configs):
+    """
+    Names of the views to render, camera_views if set and the single camera_view otherwise.
+    """
+    return list(visualizer_configs.get("camera_views", None) or [visualizer_configs["camera_view"]])
+
+
+def create_trajectory(frames, visualizer_configs):
+    """
+    Apply the configured camera views to preprocessed frames.
+    Yields:
+        Trajectory elements in frame order, dicts of view name -> frame sharing the voxels of the window.
+    """
+    camera_views = get_camera_views(visualizer_configs)
+    
+    for frame in frames:
+        yield {
+            camera_view: ScenePreprocessor.create_trajectory(
+                frame,
+                visualization_type=camera_view,
+                height=visualizer_configs["BEV_height"],
+                resolution=visualizer_configs["resolution"],
+                intrinsic_scale=visualizer_configs.get("intrinsic_scale", 1.0)
+            )
+            for camera_view in camera_views
+        }
+
+
+def cull_trajectory(trajectory, visualizer_configs):
+    """
+    Drop the voxels no view can see and optionally merge far voxels into coarser level-of-detail cells.
+    Views of a trajectory element share their voxels, so a voxel is kept when it is inside the frustum of any view
+    and merged by its distance to the nearest camera.
+    Yields:
+        Culled trajectory elements in frame order.
+    """
+    resolution = visualizer_configs["resolution"]
+    cull_margin = visualizer_configs.get("cull_margin", 0.1)
+    max_distance = visualizer_configs.get("max_distance", None)
+    lod_bands = visualizer_configs.get("lod_bands", None)
+    profiler = get_profiler()
+    
+    for trajectory_element in trajectory:
+        frames = list(trajectory_element.values())
+        
+        with profiler.stage("cull", voxels_in=len(frames[0])) as counts:
+            coord = frames[0].coord
+            
+            is_visible = np.zeros(len(frames[0]), dtype=bool)
+            for frame in frames:
+                is_visible |= ScenePreprocessor.get_visible_mask(
+                    coord,
+                    frame.voxel_sizes,
+                    frame.intrinsic,
+                    frame.extrinsic,
+                    resolution,
+                    margin=cull_margin,
+                    max_distance=max_distance
+                )
+            
+            culled_frame = ScenePreprocessor.select_voxels(frames[0], is_visible)
+            
+            if lod_bands:
+                camera_centers = np.stack([ScenePreprocessor.get_camera_center(frame.extrinsic) for frame in frames])
+                culled_frame = ScenePreprocessor.merge_lod(culled_frame, camera_centers, lod_bands)
+            
+            counts["voxels_out"] = len(culled_frame)
+        
+        yield {
+            camera_view: culled_frame.replace(extrinsic=frame.extrinsic, intrinsic=frame.intrinsic)
+            for camera_view, frame in trajectory_element.items()
+        }
+
+
+# State of a preprocessing worker process, set by ParallelPreprocessor.init_worker
+_worker_state = {}
+
+
+class ParallelPreprocessor:
+    """
+    Preprocess windows in a pool of worker processes.
+    Each task is a contiguous chunk of windows, so the incremental accumulator still slides inside a chunk.
+    Workers return coords, labels and tracking ids through shared memory and chunks are yielded in frame order.
+    """
+    def __init__(self, loader, preprocess_configs, verbose=False):
+        self.loader = loader
+        self.preprocess_configs = preprocess_configs
+        self.verbose = verbose
+        
+        self.num_workers = preprocess_configs.get("num_workers", 1)
+        self.chunk_size = preprocess_configs.get("chunk_size", 8)
+        self.max_pending_chunks = preprocess_configs.get("max_pending_chunks", 2 * self.num_workers)
+        self.window_stride = preprocess_configs.get("window_stride", 1)
+        
+        self.pool = None
+    
+    @staticmethod
+    def init_worker(loader, preprocess_configs):
+        # Workers are forked, so the loader is inherited instead of pickled
+        _worker_state["loader"] = loader.view()
+        _worker_state["preprocess_configs"] = preprocess_configs
+        
+        # The inherited profiler may have been locked at the fork, so a worker records into its own one and every chunk
+        # sends its events back to the parent
+        set_profiler(Profiler() if isinstance(get_profiler(), Profiler) else NullProfiler())
+    
+    def open(self):
+        """
+        Fork the worker pool. Call it before starting any thread, a forked worker inherits locks held by other threads
+        of the parent and would wait on them forever.
+        """
+        # Start the resource tracker before forking, so workers register their shared memory blocks with the tracker of
+        # this process, which unregisters them on unlink, instead of each starting a tracker that reports them as leaked
+        resource_tracker.ensure_running()
+        
+        context = multiprocessing.get_context("fork")
+        self.pool = context.Pool(
+            processes=self.num_workers,
+            initializer=ParallelPreprocessor.init_worker,
+            initargs=(self.loader, self.preprocess_configs)
+        )
+    
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+    
+    @staticmethod
+    def preprocess_chunk(start, stop):
+        frames = list(preprocess_scenes(
+            loader=_worker_state["loader"],
+            preprocess_configs=_worker_state["preprocess_configs"],
+            start=start,
+            stop=stop
+        ))
+        
+        return (*ParallelPreprocessor.to_shared_memory(frames), *get_profiler().pop_events())
+    
+    @staticmethod
+    def to_shared_memory(frames):
+        """
+        Copy the arrays of frames into one shared memory block.
+        Returns:
+            Name of the block and the frames with array specs (offset, shape, dtype) in place of the arrays.
+        """
+        offset = 0
+        specs = []
+        for frame in frames:
+            spec = {}
+            for key in SHARED_ARRAY_KEYS:
+                array = np.ascontiguousarray(getattr(frame, key))
+                spec[key] = (offset, array.shape, array.dtype.str)
+                offset += array.nbytes
+            
+            specs.append(spec)
+        
+        block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        
+        for frame, spec in zip(frames, specs):
+            for key in SHARED_ARRAY_KEYS:
+                array_offset, shape, dtype = spec[key]
+                np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=array_offset)[...] = getattr(frame, key)
+                setattr(frame, key, spec[key])
+        
+        name = block.name
+        block.close()
+        
+        return name, frames
+    
+    @staticmethod
+    def from_shared_memory(name, frames):
+        block = shared_memory.SharedMemory(name=name)
+        
+        for frame in frames:
+            for key in SHARED_ARRAY_KEYS:
+                array_offset, shape, dtype = getattr(frame, key)
+                setattr(frame, key, np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=array_offset).copy())
+        
+        block.close()
+        block.unlink()
+        
+        return frames
+    
+    def preprocess_scenes(self, nframe):
+        """
+        Preprocess the first nframe windows of the loader in the worker pool, forked here unless it is already open.
+        Yields:
+            Preprocessed frames in frame order.
+        """
+        # Chunks start on the window stride, chunk_size preprocessed windows each
+        chunk_span = self.chunk_size * self.window_stride
+        chunks = [(start, min(start + chunk_span, nframe)) for start in range(0, nframe, chunk_span)]
+        
+        is_pool_owned = self.pool is None
+        if is_pool_owned:
+            self.open()
+        
+        try:
+            with tqdm(total=len(range(0, nframe, self.window_stride)), disable=not self.verbose) as pbar:
+                pbar.set_description(f"Preprocessing scenes ({self.num_workers} workers)")
+                
+                pending = deque()
+                next_chunk = 0
+                while next_chunk < len(chunks) or pending:
+                    # Keep a bounded number of chunks in flight
+                    while next_chunk < len(chunks) and len(pending) < self.max_pending_chunks:
+                        pending.append(self.pool.apply_async(ParallelPreprocessor.preprocess_chunk, chunks[next_chunk]))
+                        next_chunk += 1
+                    
+                    name, frames, events, thread_names = pending.popleft().get()
+                    get_profiler().merge(events, thread_names)
+                    
+                    for frame in ParallelPreprocessor.from_shared_memory(name, frames):
+                        pbar.update(1)
+                        yield frame
+        
+        finally:
+            if is_pool_owned:
+                self.close()
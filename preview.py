@@ -0,0 +1,184 @@
+import copy
+import time
+import os.path as osp
+from pipeline import preprocess_scenes, create_trajectory, cull_trajectory
+from visualizer import Visualizer
+
+# Preview levels from the finest to the coarsest:
+# (voxel size factor, window stride, sweeps per window factor, resolution factor)
+PREVIEW_LEVELS = [
+    (1.0, 1, 1.0, 1.0),
+    (1.5, 2, 1.0, 0.75),
+    (2.0, 2, 0.6, 0.5),
+    (2.0, 4, 0.4, 0.5),
+    (3.0, 4, 0.4, 0.5),
+    (4.0, 8, 0.2, 0.33),
+    (5.0, 10, 0.2, 0.25),
+]
+
+
+class PreviewPlanner:
+    """
+    Pick the finest preview level that renders a clip within a wall-clock budget or at a frames-per-second goal.
+    Every candidate level is probed on the first window, from the coarsest up, and its whole run is estimated from the
+    probe: compute time per rendered window plus the sweep reads a window adds at its stride.
+    Sweep reads are timed once, before any probe, since later reads of the same files come from the page cache.
+    Probes share one renderer at the full quality resolution, so a window renderer opens a single window and rendering
+    is estimated conservatively for the levels with a lower resolution.
+    The planner keeps the loader, so a full quality pass can reuse its resolved metadata afterwards.
+    """
+    def __init__(self, loader, loader_configs, preprocess_configs, visualizer_configs, verbose=False):
+        self.loader = loader
+        self.loader_configs = loader_configs
+        self.preprocess_configs = preprocess_configs
+        self.visualizer_configs = visualizer_configs
+        self.verbose = verbose
+    
+    def make_configs(self, level):
+        """
+        Copies of the configs with the settings of a preview level.
+        """
+        voxel_factor, window_stride, sweep_factor, resolution_factor = PREVIEW_LEVELS[level]
+        
+        loader_configs = copy.deepcopy(self.loader_configs)
+        loader_configs["nsample_per_frame"] = max(1, round(self.loader_configs["nsample_per_frame"] * sweep_factor))
+        
+        preprocess_configs = copy.deepcopy(self.preprocess_configs)
+        preprocess_configs["voxel_size"] = self.preprocess_configs["voxel_size"] * voxel_factor
+        preprocess_configs["window_stride"] = window_stride
+        preprocess_configs["use_cache"] = False  # Previews are not worth caching
+        preprocess_configs["num_workers"] = 1
+        preprocess_configs["profile_path"] = None
+        
+        visualizer_configs = copy.deepcopy(self.visualizer_configs)
+        visualizer_configs["resolution"] = [2 * max(1, round(size * resolution_factor / 2)) for size in self.visualizer_configs["resolution"]]  # Even sizes for the encoders
+        visualizer_configs["intrinsic_scale"] = self.visualizer_configs.get("intrinsic_scale", 1.0) * visualizer_configs["resolution"][0] / self.visualizer_configs["resolution"][0]
+        visualizer_configs["fps"] = max(1, self.visualizer_configs["fps"] / window_stride)  # Play back in real time
+        stem, extension = osp.splitext(self.visualizer_configs["output_name"])
+        visualizer_configs["output_name"] = f"{stem}_preview{extension}"
+        
+        return loader_configs, preprocess_configs, visualizer_configs
+    
+    def make_loader(self, loader_configs, preprocess_configs):
+        return self.loader.view(nsample_per_frame=loader_configs["nsample_per_frame"], window_stride=preprocess_configs.get("window_stride", 1))
+    
+    def measure_sweep_time(self):
+        """
+        Time reading the sweeps of the first full quality window, which covers the first window of every level.
+        Returns:
+            Seconds to read one sweep with a cold page cache.
+        """
+        number_of_sweeps = min(self.loader_configs["nsample_per_frame"], len(self.loader.sample_tokens))
+        
+        for idx in range(number_of_sweeps):  # Resolve the sample metadata first, only the reads are timed
+            self.loader.get_sample_metadata(idx)
+        
+        start = time.perf_counter()
+        for idx in range(number_of_sweeps):
+            self.loader.read_sweep(idx)
+        
+        return (time.perf_counter() - start) / number_of_sweeps
+    
+    def probe(self, level, visualizer):
+        """
+        Time the first window of a preview level.
+        Args:
+            level: Preview level.
+            visualizer: Visualizer with an open renderer at the full quality resolution, shared by the probes.
+        Returns:
+            Seconds to preprocess, wrap up and render one window with its sweeps in memory.
+        """
+        loader_configs, preprocess_configs, visualizer_configs = self.make_configs(level)
+        visualizer_configs.update(resolution=self.visualizer_configs["resolution"], intrinsic_scale=self.visualizer_configs.get("intrinsic_scale", 1.0))
+        loader = self.make_loader(loader_configs, preprocess_configs)
+        
+        try:
+            loader[0]  # Reads the sweeps of the window into the sweep cache, their reads are timed once by the planner
+            
+            start = time.perf_counter()
+            trajectory = create_trajectory(preprocess_scenes(loader, preprocess_configs, 0, 1), visualizer_configs)
+            if visualizer_configs.get("culling", False):
+                trajectory = cull_trajectory(trajectory, visualizer_configs)
+            
+            scene = visualizer.wrapup_scene(next(trajectory), preprocess_configs["voxel_size"])
+            visualizer.renderer.render(scene)
+            compute_time = time.perf_counter() - start
+        
+        finally:
+            loader.close()
+        
+        return compute_time
+    
+    def estimate(self, level, sweep_time, compute_time, nframe):
+        """
+        Estimate the wall-clock time of a whole preview and its time per rendered window.
+        """
+        loader_configs, preprocess_configs, _ = self.make_configs(level)
+        window_stride = preprocess_configs["window_stride"]
+        
+        frame_time = compute_time + sweep_time * min(window_stride, loader_configs["nsample_per_frame"])
+        
+        return len(range(0, nframe, window_stride)) * frame_time, frame_time
+    
+    def plan(self, time_budget=None, fps=None):
+        """
+        Pick a preview level.
+        Args:
+            time_budget: Wall-clock seconds for the whole preview, probing included.
+            fps: Goal of rendered windows per second.
+        Returns:
+            Level index, its loader, preprocess and visualizer configs, and the report of the probes.
+        """
+        if time_budget is None and fps is None:
+            raise ValueError("Either a time budget or an fps goal is required")
+        
+        nframe = min(self.loader_configs["nframe"], len(self.loader.sample_tokens))
+        start = time.perf_counter()
+        
+        sweep_time = self.measure_sweep_time()
+        
+        visualizer = Visualizer(configs=self.visualizer_configs)
+        visualizer.renderer.open()
+        
+        chosen_level = len(PREVIEW_LEVELS) - 1
+        report = []
+        try:
+            for level in reversed(range(len(PREVIEW_LEVELS))):  # Coarsest first, probes get slower as levels get finer
+                compute_time = self.probe(level, visualizer)
+                total_time, frame_time = self.estimate(level, sweep_time, compute_time, nframe)
+                report.append({"level": level, "estimated_seconds": total_time, "seconds_per_frame": frame_time})
+                
+                remaining_budget = time_budget - (time.perf_counter() - start) if time_budget is not None else None
+                is_fitting = (remaining_budget is None or total_time <= remaining_budget) and (fps is None or frame_time <= 1 / fps)
+                
+                if not is_fitting:
+                    break
+                
+                chosen_level = level
+        
+        finally:
+            visualizer.renderer.close()
+        
+        return (chosen_level, *self.make_configs(chosen_level), report)
+    
+    def describe(self, level, report):
+        """
+        Summary of the chosen settings against the full quality ones.
+        """
+        loader_configs, preprocess_configs, visualizer_configs = self.make_configs(level)
+        estimate = next((entry for entry in report if entry["level"] == level), None)
+        
+        lines = [
+            f"Preview level {level} of {len(PREVIEW_LEVELS) - 1}"
+            + (f", estimated {estimate['estimated_seconds']:.1f}s ({estimate['seconds_per_frame']:.2f}s per frame)" if estimate is not None else ""),
+            f"voxel_size: {self.preprocess_configs['voxel_size']} -> {preprocess_configs['voxel_size']}",
+            f"window_stride: {self.preprocess_configs.get('window_stride', 1)} -> {preprocess_configs['window_stride']}",
+            f"nsample_per_frame: {self.loader_configs['nsample_per_frame']} -> {loader_configs['nsample_per_frame']}",
+            f"resolution: {self.visualizer_configs['resolution']} -> {visualizer_configs['resolution']}",
+        ]
+        
+        if self.verbose:
+            lines += [f"level {entry['level']}: estimated {entry['estimated_seconds']:.1f}s, {entry['seconds_per_frame']:.2f}s per frame" for entry in report]
+        
+        return "\n".join(lines)
+
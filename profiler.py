@@ -0,0 +1,183 @@
+import os
+import json
+import time
+import resource
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+def get_peak_rss():
+    """
+    Peak resident set size of this process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in kilobytes on Linux
+
+
+class Profiler:
+    """
+    Record the wall time, point/voxel counts and peak RSS of every pipeline stage and frame.
+    Stages may run in several threads, and in forked worker processes whose events are merged in.
+    Results are written as Chrome trace events (chrome://tracing, Perfetto) and summarized per stage.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.start_time = time.perf_counter_ns()
+        self.events = []
+        self.thread_names = {}
+        self.stage_counters = defaultdict(int)
+        self.lock = threading.Lock()
+    
+    @contextmanager
+    def stage(self, name, frame=None, view=None, **counts):
+        """
+        Time a stage.
+        Args:
+            name: Stage name.
+            frame: Frame index, defaults to the number of previous records of the stage since stages process frames in order.
+                Stages recording several events per frame, e.g. one per view, have to pass it.
+            view: Optional name of the view the stage works on.
+            counts: Counts known up front, e.g. points_in. More can be added to the yielded dict.
+        Yields:
+            Dict of counts recorded with the stage.
+        """
+        with self.lock:
+            if frame is None:
+                frame = self.stage_counters[name]
+            
+            self.stage_counters[name] += 1
+        
+        thread = threading.current_thread()
+        self.thread_names[(self.pid, thread.ident)] = thread.name
+        
+        start = time.perf_counter_ns()
+        try:
+            yield counts
+        
+        finally:
+            end = time.perf_counter_ns()
+            self.events.append({
+                "name": name,
+                "frame": frame,
+                "view": view,
+                "start": start,
+                "duration": end - start,
+                "pid": self.pid,
+                "tid": thread.ident,
+                "counts": dict(counts),
+                "peak_rss": get_peak_rss(),
+            })
+    
+    def pop_events(self):
+        """
+        Take the events recorded so far, e.g. to send them from a worker process to the profiler of the parent.
+        Returns:
+            List of events and dict of thread names keyed by (pid, tid).
+        """
+        with self.lock:
+            events, self.events = self.events, []
+            thread_names, self.thread_names = self.thread_names, {}
+        
+        return events, thread_names
+    
+    def merge(self, events, thread_names):
+        """
+        Add the events of another profiler, e.g. one of a forked worker. perf_counter_ns is a system wide monotonic
+        clock on Linux, so their start times line up with the events of this process.
+        """
+        with self.lock:
+            self.events.extend(events)
+            self.thread_names.update(thread_names)
+    
+    def write_chrome_trace(self, path):
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": thread_name}}
+            for (pid, tid), thread_name in self.thread_names.items()
+        ]
+        
+        for event in self.events:
+            timestamp = (event["start"] - self.start_time) / 1000  # Trace timestamps are in microseconds
+            
+            trace_events.append({
+                "name": event["name"],
+                "cat": "stage",
+                "ph": "X",
+                "ts": timestamp,
+                "dur": event["duration"] / 1000,
+                "pid": event["pid"],
+                "tid": event["tid"],
+                "args": {"frame": event["frame"], **({"view": event["view"]} if event["view"] is not None else {}), **event["counts"]},
+            })
+            trace_events.append({
+                "name": "peak_rss_mb",
+                "ph": "C",
+                "ts": timestamp,
+                "pid": event["pid"],
+                "args": {"peak_rss_mb": event["peak_rss"] / 2 ** 20},
+            })
+        
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    
+    def summary(self):
+        """
+        Per stage table of call counts, total/mean/max wall time, the slowest frame and summed counts.
+        """
+        events_per_stage = defaultdict(list)
+        for event in self.events:
+            events_per_stage[event["name"]].append(event)
+        
+        lines = [f"{'stage':<20}{'calls':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}{'slowest':>9}  counts"]
+        for name, events in events_per_stage.items():
+            durations = [event["duration"] / 1e6 for event in events]
+            slowest = max(events, key=lambda event: event["duration"])
+            
+            counts = defaultdict(int)
+            for event in events:
+                for key, value in event["counts"].items():
+                    counts[key] += value
+            
+            lines.append(
+                f"{name:<20}{len(events):>8}{sum(durations) / 1000:>10.2f}{sum(durations) / len(durations):>10.1f}{max(durations):>10.1f}{slowest['frame']:>9}  "
+                + ", ".join(f"{key}={value:,}" for key, value in counts.items())
+            )
+        
+        lines.append(f"peak RSS: {get_peak_rss() / 2 ** 20:.0f} MB")
+        
+        return "\n".join(lines)
+    
+    def write(self, path):
+        """
+        Write the Chrome trace to path and the summary table next to it.
+        """
+        self.write_chrome_trace(path)
+        
+        with open(os.path.splitext(path)[0] + "_summary.txt", "w") as f:
+            f.write(self.summary() + "\n")
+
+
+class NullProfiler:
+    """
+    Profiler doing nothing, used when profiling is disabled.
+    """
+    @contextmanager
+    def stage(self, name, frame=None, view=None, **counts):
+        yield counts
+    
+    def pop_events(self):
+        return [], {}
+    
+    def merge(self, events, thread_names):
+        pass
+
+
+_profiler = NullProfiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+def set_profiler(profiler):
+    global _profiler
+    _profiler = profiler
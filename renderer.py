@@ -0,0 +1,462 @@
+import numpy as np
+import open3d as o3d
+from profiler import get_profiler
+from scene_preprocessor import ScenePreprocessor
+
+DEFAULT_FIELD_OF_VIEW = 60.0  # Open3D ViewControl default field of view in degrees
+BACKGROUND_COLOR = np.array([255, 255, 255], dtype=np.uint8)
+VOXEL_SCALE = 0.95  # Rendered voxel edge relative to the voxel size, leaves a gap between voxels
+
+# Unit cube as 6 faces of 4 vertices, so every face gets its own flat normal
+CUBE_VERTICES = np.array([
+    [-1, -1, -1], [-1, 1, -1], [1, 1, -1], [1, -1, -1],  # -z
+    [-1, -1, 1], [1, -1, 1], [1, 1, 1], [-1, 1, 1],  # +z
+    [-1, -1, -1], [1, -1, -1], [1, -1, 1], [-1, -1, 1],  # -y
+    [-1, 1, -1], [-1, 1, 1], [1, 1, 1], [1, 1, -1],  # +y
+    [-1, -1, -1], [-1, -1, 1], [-1, 1, 1], [-1, 1, -1],  # -x
+    [1, -1, -1], [1, 1, -1], [1, 1, 1], [1, -1, 1],  # +x
+], dtype=np.float64) / 2
+CUBE_TRIANGLES = np.array([[face * 4, face * 4 + 1, face * 4 + 2] for face in range(6)] + [[face * 4, face * 4 + 2, face * 4 + 3] for face in range(6)], dtype=np.int32)
+CUBE_NORMALS = np.repeat(np.array([[0, 0, -1], [0, 0, 1], [0, -1, 0], [0, 1, 0], [-1, 0, 0], [1, 0, 0]], dtype=np.float64), 4, axis=0)
+
+
+def get_default_intrinsic(resolution):
+    """
+    Intrinsic matrix Open3D uses for a window of the given resolution, computed without opening one.
+    Args:
+        resolution: (width, height).
+    Returns:
+        3x3 intrinsic matrix.
+    """
+    width, height = resolution
+    focal_length = height / (2 * np.tan(np.deg2rad(DEFAULT_FIELD_OF_VIEW) / 2))
+    
+    return np.array([
+        [focal_length, 0, width / 2 - 0.5],
+        [0, focal_length, height / 2 - 0.5],
+        [0, 0, 1]
+    ])
+
+
+def voxels_to_mesh(coords, colors, voxel_size):
+    """
+    Build one triangle mesh of cubes for all voxels.
+    Args:
+        coords: Nx3 voxel centers.
+        colors: Nx3 colors in [0, 1].
+        voxel_size: Cube edge length, a scalar or one per voxel.
+    Returns:
+        Open3D triangle mesh.
+    """
+    vertices = (coords[:, None, :] + np.reshape(voxel_size, (-1, 1, 1)) * CUBE_VERTICES[None, :, :]).reshape(-1, 3)
+    triangles = (CUBE_TRIANGLES[None, :, :] + len(CUBE_VERTICES) * np.arange(coords.shape[0], dtype=np.int32)[:, None, None]).reshape(-1, 3)
+    vertex_colors = np.repeat(colors, len(CUBE_VERTICES), axis=0)
+    
+    mesh = o3d.geometry.TriangleMesh()
+    mesh.vertices = o3d.utility.Vector3dVector(vertices)
+    mesh.triangles = o3d.utility.Vector3iVector(triangles)
+    mesh.vertex_colors = o3d.utility.Vector3dVector(vertex_colors)
+    mesh.compute_triangle_normals()
+    mesh.compute_vertex_normals()
+    
+    return mesh
+
+
+class Renderer:
+    """
+    Interface of the rendering backends.
+    wrap turns a trajectory element, a dict of view name -> frame sharing the same voxels, into the geometry and the
+    cameras the backend renders. render draws the geometry once per camera into uint8 RGB frames.
+    The frame index of a wrapped scene labels the profiler events of its rendering.
+    """
+    def __init__(self, resolution, color_map):
+        self.resolution = resolution
+        self.color_map = color_map
+    
+    def wrap(self, trajectory_element, voxel_size, frame_index=None):
+        frame = next(iter(trajectory_element.values()))
+        
+        return {
+            "frame_index": frame_index,
+            "geometry": self.wrap_geometry(frame, voxel_size),
+            "cameras": {view: self.wrap_camera(frame) for view, frame in trajectory_element.items()}
+        }
+    
+    def wrap_geometry(self, frame, voxel_size):
+        raise NotImplementedError
+    
+    def wrap_camera(self, frame):
+        raise NotImplementedError
+    
+    def open(self):
+        pass
+    
+    def render(self, scene):
+        """
+        Render a wrapped scene from every camera.
+        Returns:
+            Dict of view name -> HxWx3 uint8 RGB image.
+        """
+        frame_index = scene.get("frame_index", None)
+        self.set_geometry(scene["geometry"], frame_index=frame_index)
+        
+        return {view: self.render_view(camera, frame_index=frame_index, view=view) for view, camera in scene["cameras"].items()}
+    
+    def set_geometry(self, geometry, frame_index=None):
+        raise NotImplementedError
+    
+    def render_view(self, camera, frame_index=None, view=None):
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+
+
+class WindowRenderer(Renderer):
+    """
+    Render in an Open3D window. Needs a display server.
+    """
+    def wrap_geometry(self, frame, voxel_size):
+        if frame.voxel_scale is None:
+            return [WindowRenderer.make_voxel_grid(frame.coord, self.color_map[frame.label], VOXEL_SCALE * voxel_size)]
+        
+        # A voxel grid has a single voxel size, so make one per level of detail
+        coord = frame.coord
+        
+        return [
+            WindowRenderer.make_voxel_grid(coord[frame.voxel_scale == scale], self.color_map[frame.label[frame.voxel_scale == scale]], VOXEL_SCALE * voxel_size * scale)
+            for scale in np.unique(frame.voxel_scale)
+        ]
+    
+    @staticmethod
+    def make_voxel_grid(coord, colors, voxel_size):
+        # Wrap up to Open3D geometry
+        pcd = o3d.geometry.PointCloud()
+        pcd.points = o3d.utility.Vector3dVector(coord)
+        pcd.colors = o3d.utility.Vector3dVector(colors)
+        
+        return o3d.geometry.VoxelGrid.create_from_point_cloud(pcd, voxel_size)
+    
+    def wrap_camera(self, frame):
+        # Wrap up to Open3D camera parameters
+        parameter = o3d.camera.PinholeCameraParameters()
+        
+        parameter.intrinsic = o3d.camera.PinholeCameraIntrinsic(
+            width=self.resolution[0],
+            height=self.resolution[1],
+            intrinsic_matrix=frame.intrinsic
+        )
+        
+        parameter.extrinsic = np.copy(frame.extrinsic)
+        
+        return parameter
+    
+    def open(self):
+        self.vis = o3d.visualization.Visualizer()
+        self.vis.create_window(width=self.resolution[0], height=self.resolution[1])
+        # opt = vis.get_render_option()
+        # opt.background_color = np.asarray([0, 0, 0])
+        self.ctr = self.vis.get_view_control()
+    
+    def set_geometry(self, geometry, frame_index=None):
+        with get_profiler().stage("render", frame=frame_index):
+            # Load voxel grids, once for every view of the frame
+            self.vis.clear_geometries()
+            for voxel_grid in geometry:
+                self.vis.add_geometry(voxel_grid)
+    
+    def render_view(self, camera, frame_index=None, view=None):
+        profiler = get_profiler()
+        
+        with profiler.stage("render", frame=frame_index, view=view):
+            # Set camera parameters
+            self.ctr.convert_from_pinhole_camera_parameters(
+                    camera,
+                    allow_arbitrary=True
+            )
+            
+            self.vis.poll_events()
+            self.vis.update_renderer()
+        
+        with profiler.stage("capture", frame=frame_index, view=view):
+            image = self.vis.capture_screen_float_buffer(do_render=True)
+            
+            return (255 * np.asarray(image)).astype(np.uint8)
+    
+    def close(self):
+        self.vis.destroy_window()
+
+
+class VoxelSlotAllocator:
+    """
+    Assign the voxels of consecutive frames to slots of a persistent cube mesh.
+    Every frame is diffed against the previous one by voxel key, so a slot keeps its voxel as long as the voxel stays in
+    the window and only added, removed and recolored voxels have to be written into the mesh.
+    """
+    def __init__(self, initial_capacity=1 << 16):
+        self.capacity = initial_capacity
+        self.keys = np.empty((0,), dtype=np.int64)  # Sorted voxel keys of the previous frame
+        self.slots = np.empty((0,), dtype=np.int64)
+        self.labels = np.empty((0,), dtype=np.uint8)
+        self.scales = np.empty((0,), dtype=np.uint8)
+        self.free_slots = np.arange(initial_capacity, dtype=np.int64)
+    
+    def update(self, frame):
+        """
+        Diff a frame against the previous one.
+        Returns:
+            Patch of the mesh: slots to clear and slots to (re)write with their cubes, with the mesh capacity.
+        """
+        keys = ScenePreprocessor.pack_voxel_keys(frame.voxel_indices + frame.origin_index)
+        order = np.argsort(keys, kind="stable")
+        keys, labels = keys[order], np.asarray(frame.label)[order]
+        scales = frame.voxel_scale[order] if frame.voxel_scale is not None else np.ones(keys.shape[0], dtype=np.uint8)
+        
+        position = np.searchsorted(self.keys, keys)
+        is_existing = position < self.keys.shape[0]
+        is_existing[is_existing] = self.keys[position[is_existing]] == keys[is_existing]
+        
+        is_kept = np.zeros(self.keys.shape[0], dtype=bool)
+        is_kept[position[is_existing]] = True
+        removed_slots = self.slots[~is_kept]
+        
+        # Reuse the slots of removed voxels first, then free slots, and grow the mesh when they run out
+        free_slots = np.concatenate([removed_slots, self.free_slots])
+        number_of_added = int((~is_existing).sum())
+        if number_of_added > free_slots.shape[0]:
+            capacity = max(2 * self.capacity, self.capacity + number_of_added - free_slots.shape[0])
+            free_slots = np.concatenate([free_slots, np.arange(self.capacity, capacity, dtype=np.int64)])
+            self.capacity = capacity
+        
+        slots = np.empty(keys.shape[0], dtype=np.int64)
+        slots[is_existing] = self.slots[position[is_existing]]
+        slots[~is_existing] = free_slots[:number_of_added]
+        self.free_slots = free_slots[number_of_added:]
+        
+        # Kept voxels are rewritten when their label or level of detail changes
+        is_changed = np.zeros(keys.shape[0], dtype=bool)
+        is_changed[is_existing] = (self.labels[position[is_existing]] != labels[is_existing]) | (self.scales[position[is_existing]] != scales[is_existing])
+        is_written = ~is_existing | is_changed
+        
+        self.keys, self.slots, self.labels, self.scales = keys, slots, labels, scales
+        
+        return {
+            "capacity": self.capacity,
+            "number_of_added": number_of_added,
+            "number_of_removed": removed_slots.shape[0],
+            "number_of_changed": int(is_changed.sum()),
+            "cleared_slots": removed_slots[number_of_added:],  # Removed voxels whose slot is not reused
+            "written_slots": slots[is_written],
+            "written_coords": frame.coord[order[is_written]],
+            "written_labels": labels[is_written],
+            "written_scales": scales[is_written],
+        }
+
+
+class IncrementalWindowRenderer(WindowRenderer):
+    """
+    Render in an Open3D window from one persistent cube mesh updated in place.
+    Instead of building a VoxelGrid and re-adding it every frame, wrap diffs the frame against the previous one and render
+    writes only the changed cubes into the mesh buffers before update_geometry. Wrapped scenes must be rendered in order.
+    """
+    def __init__(self, resolution, color_map):
+        super().__init__(resolution, color_map)
+        
+        self.allocator = VoxelSlotAllocator()
+        self.mesh = None
+        self.capacity = 0
+    
+    def wrap_geometry(self, frame, voxel_size):
+        patch = self.allocator.update(frame)
+        patch["cube_size"] = VOXEL_SCALE * voxel_size * patch["written_scales"]
+        
+        return patch
+    
+    def allocate(self, capacity):
+        """
+        Grow the mesh buffers to the given number of cubes, keeping the cubes already in them.
+        Unused cubes are collapsed to a point, so their triangles are degenerate and never rasterized.
+        self.vertices and self.colors are views of the mesh buffers, so cubes are written into the mesh in place.
+        """
+        vertices = np.zeros((capacity * len(CUBE_VERTICES), 3))
+        colors = np.zeros((capacity * len(CUBE_VERTICES), 3))
+        
+        if self.mesh is not None:
+            vertices[:self.capacity * len(CUBE_VERTICES)] = self.vertices.reshape(-1, 3)
+            colors[:self.capacity * len(CUBE_VERTICES)] = self.colors.reshape(-1, 3)
+        
+        self.mesh = o3d.geometry.TriangleMesh()
+        self.mesh.vertices = o3d.utility.Vector3dVector(vertices)
+        self.mesh.vertex_colors = o3d.utility.Vector3dVector(colors)
+        self.mesh.triangles = o3d.utility.Vector3iVector(
+            (CUBE_TRIANGLES[None, :, :] + len(CUBE_VERTICES) * np.arange(capacity, dtype=np.int32)[:, None, None]).reshape(-1, 3)
+        )
+        self.mesh.vertex_normals = o3d.utility.Vector3dVector(np.tile(CUBE_NORMALS, (capacity, 1)))
+        
+        # Open3D vectors expose their memory through the buffer protocol
+        self.vertices = np.asarray(self.mesh.vertices).reshape(capacity, len(CUBE_VERTICES), 3)
+        self.colors = np.asarray(self.mesh.vertex_colors).reshape(capacity, len(CUBE_VERTICES), 3)
+        self.capacity = capacity
+    
+    def set_geometry(self, geometry, frame_index=None):
+        with get_profiler().stage("render", frame=frame_index) as counts:
+            is_reallocated = geometry["capacity"] != self.capacity
+            if is_reallocated:
+                self.allocate(geometry["capacity"])
+            
+            # Only the changed slots are touched, directly in the mesh buffers
+            self.vertices[geometry["cleared_slots"]] = 0
+            self.vertices[geometry["written_slots"]] = geometry["written_coords"][:, None, :] + geometry["cube_size"][:, None, None] * CUBE_VERTICES[None, :, :]
+            self.colors[geometry["written_slots"]] = self.color_map[geometry["written_labels"]][:, None, :]
+            
+            if is_reallocated:  # New buffers, add the mesh again
+                self.vis.clear_geometries()
+                self.vis.add_geometry(self.mesh)
+            
+            else:
+                self.vis.update_geometry(self.mesh)
+            
+            counts["voxels_added"] = geometry["number_of_added"]
+            counts["voxels_removed"] = geometry["number_of_removed"]
+            counts["voxels_changed"] = geometry["number_of_changed"]
+
+
+class OffscreenRenderer(Renderer):
+    """
+    Render with Open3D's headless offscreen renderer. Voxels are drawn as one mesh of cubes.
+    """
+    def wrap_geometry(self, frame, voxel_size):
+        return voxels_to_mesh(
+            frame.coord,
+            self.color_map[frame.label],
+            VOXEL_SCALE * voxel_size * (frame.voxel_scale if frame.voxel_scale is not None else 1)
+        )
+        
+    def wrap_camera(self, frame):
+        return {
+            "intrinsic": frame.intrinsic,
+            "extrinsic": frame.extrinsic
+        }
+    
+    def open(self):
+        self.renderer = o3d.visualization.rendering.OffscreenRenderer(self.resolution[0], self.resolution[1])
+        self.renderer.scene.set_background([1.0, 1.0, 1.0, 1.0])
+        
+        self.material = o3d.visualization.rendering.MaterialRecord()
+        self.material.shader = "defaultLit"
+    
+    def set_geometry(self, geometry, frame_index=None):
+        with get_profiler().stage("render", frame=frame_index):
+            self.renderer.scene.clear_geometry()
+            self.renderer.scene.add_geometry("voxels", geometry, self.material)
+    
+    def render_view(self, camera, frame_index=None, view=None):
+        profiler = get_profiler()
+        
+        with profiler.stage("render", frame=frame_index, view=view):
+            self.renderer.setup_camera(camera["intrinsic"], camera["extrinsic"], self.resolution[0], self.resolution[1])
+        
+        with profiler.stage("capture", frame=frame_index, view=view):
+            return np.asarray(self.renderer.render_to_image())
+    
+    def close(self):
+        del self.renderer
+
+
+class NumpyRenderer(Renderer):
+    """
+    Headless z-buffer renderer splatting every voxel as a screen space square. Needs neither a display nor a GPU.
+    """
+    def __init__(self, resolution, color_map, max_splat_radius=32, near=0.1):
+        super().__init__(resolution, color_map)
+        
+        self.max_splat_radius = max_splat_radius
+        self.near = near
+        self.color_table = np.round(255 * color_map).astype(np.uint8)
+        self.geometry = None
+    
+    def wrap_geometry(self, frame, voxel_size):
+        return {
+            "coord": frame.coord,
+            "label": frame.label,
+            "voxel_size": VOXEL_SCALE * voxel_size * (frame.voxel_scale if frame.voxel_scale is not None else 1)
+        }
+    
+    def wrap_camera(self, frame):
+        return {
+            "intrinsic": frame.intrinsic,
+            "extrinsic": frame.extrinsic
+        }
+    
+    def set_geometry(self, geometry, frame_index=None):
+        self.geometry = geometry
+    
+    def render_view(self, camera, frame_index=None, view=None):
+        with get_profiler().stage("render", frame=frame_index, view=view, voxels_in=len(self.geometry["label"])):
+            return self.rasterize({**self.geometry, **camera})
+    
+    def rasterize(self, scene):
+        width, height = self.resolution
+        intrinsic, extrinsic = scene["intrinsic"], scene["extrinsic"]
+        
+        # World to camera
+        camera_coords = scene["coord"] @ extrinsic[:3, :3].T + extrinsic[:3, 3]
+        is_visible = camera_coords[:, 2] > self.near
+        camera_coords, labels = camera_coords[is_visible], scene["label"][is_visible]
+        voxel_size = np.broadcast_to(scene["voxel_size"], scene["label"].shape)[is_visible]  # Scalar or one per voxel
+        depth = camera_coords[:, 2]
+        
+        # Project voxel centers and their screen space half size
+        u = intrinsic[0, 0] * camera_coords[:, 0] / depth + intrinsic[0, 2]
+        v = intrinsic[1, 1] * camera_coords[:, 1] / depth + intrinsic[1, 2]
+        radius = np.clip(np.ceil(0.5 * voxel_size * intrinsic[0, 0] / depth - 0.5), 0, self.max_splat_radius).astype(np.int64)
+        u, v = np.round(u).astype(np.int64), np.round(v).astype(np.int64)
+        
+        is_visible = (u + radius >= 0) & (u - radius < width) & (v + radius >= 0) & (v - radius < height)
+        u, v, radius, depth, labels = u[is_visible], v[is_visible], radius[is_visible], depth[is_visible], labels[is_visible]
+        
+        # Splat voxels of the same screen space size together
+        list_of_pixel, list_of_depth, list_of_label = [], [], []
+        for splat_radius in np.unique(radius):
+            is_radius = radius == splat_radius
+            offsets = np.arange(-splat_radius, splat_radius + 1)
+            du, dv = np.meshgrid(offsets, offsets)
+            
+            splat_u = (u[is_radius, None] + du.reshape(1, -1)).reshape(-1)
+            splat_v = (v[is_radius, None] + dv.reshape(1, -1)).reshape(-1)
+            is_inside = (splat_u >= 0) & (splat_u < width) & (splat_v >= 0) & (splat_v < height)
+            
+            list_of_pixel.append((splat_v * width + splat_u)[is_inside])
+            list_of_depth.append(np.repeat(depth[is_radius], du.size)[is_inside])
+            list_of_label.append(np.repeat(labels[is_radius], du.size)[is_inside])
+        
+        image = np.empty((height * width, 3), dtype=np.uint8)
+        image[:] = BACKGROUND_COLOR
+        
+        if list_of_pixel:
+            pixels, depths, splat_labels = np.concatenate(list_of_pixel), np.concatenate(list_of_depth), np.concatenate(list_of_label)
+            
+            # Z-buffer: keep the nearest fragment of every pixel
+            order = np.lexsort((depths, pixels))
+            pixels, splat_labels = pixels[order], splat_labels[order]
+            is_nearest = np.ones(pixels.shape[0], dtype=bool)
+            is_nearest[1:] = pixels[1:] != pixels[:-1]
+            
+            image[pixels[is_nearest]] = self.color_table[splat_labels[is_nearest]]
+        
+        return image.reshape(height, width, 3)
+
+
+RENDERERS = {
+    "window": WindowRenderer,
+    "window_incremental": IncrementalWindowRenderer,
+    "offscreen": OffscreenRenderer,
+    "numpy": NumpyRenderer,
+}
+
+
+def make_renderer(name, resolution, color_map):
+    if name not in RENDERERS:
+        raise ValueError(f"Invalid renderer: {name}")
+    
+    return RENDERERS[name](resolution, color_map)
@@ -1,15 +1,19 @@
-import numpy as np
 import yaml
-import torch
 import argparse
-from tqdm import tqdm
+import os.path as osp
 from loader import Loader
-from utils import unzip
-from scene_preprocessor import ScenePreprocessor
+from utils import threaded_generator
+from pipeline import preprocess_scenes, create_trajectory, cull_trajectory, ParallelPreprocessor
+from frame_cache import FrameCache
+from profiler import Profiler, set_profiler
 from visualizer import Visualizer
+from preview import PreviewPlanner
 
 
-def main(loader_configs, preprocess_configs, visualizer_configs, verbose=False):
+CONFIG_DIRECTORY = osp.join(osp.dirname(osp.abspath(__file__)), "configs")
+
+
+def main(loader_configs, preprocess_configs, visualizer_configs, verbose=False, profile_path=None, nusc=None, loader=None, predictions=None):
     
     if verbose:
         print("Loader configs:")
@@ -24,54 +28,143 @@ def main(loader_configs, preprocess_configs, visualizer_configs, verbose=False):
         for key, value in visualizer_configs.items():
             print(f"{key}: {value}")
     
-    # Initialize loader
-    loader = Loader(configs=loader_configs, verbose=verbose)
+    # Record per stage timings when profiling
+    profile_path = profile_path or preprocess_configs.get("profile_path", None)
+    if profile_path is not None:
+        profiler = Profiler()
+        set_profiler(profiler)
     
     # Initialize visualizer
     visualizer = Visualizer(configs=visualizer_configs, verbose=verbose)
 
     voxel_size = preprocess_configs["voxel_size"]
-
-    trajectory = []
-    with tqdm(enumerate(loader), total=loader_configs["nframe"], disable=not verbose) as pbar:
-        pbar.set_description("Preprocessing scenes")
-        for i, scene_data in pbar:
-            if i >= loader_configs["nframe"]:
-                break
+    nframe = loader_configs["nframe"]
+    streaming = preprocess_configs.get("streaming", False)
+    window_stride = preprocess_configs.get("window_stride", 1)
+    
+    frame_cache = None
+    if preprocess_configs.get("use_cache", False) and window_stride == 1:  # The cache holds consecutive windows
+        frame_cache = FrameCache(preprocess_configs["cache_dir"], loader_configs, preprocess_configs, verbose=verbose)
+    
+    # A loader passed by the caller, e.g. the one of a preview, is reused for its resolved metadata and not closed
+    is_loader_owned = loader is None
+    preprocessor = None
+    trajectory = None
+    wraped_up_scenes = None
+    
+    try:
+        if frame_cache is not None and frame_cache.is_complete(nframe):
+            # Re-render from cached frames without touching the dataset
+            frames = frame_cache.load_frames(nframe)
+        
+        else:
+            # Initialize loader
+            if loader is None:
+                loader = Loader(configs=loader_configs, nusc=nusc, verbose=verbose, window_stride=window_stride, predictions=predictions)
+            
+            nframe = min(nframe, len(loader.sample_tokens))
             
-            coords, labels = [torch.tensor(coord)[:, :3] for coord in scene_data["pcd"]], [torch.tensor(label) for label in scene_data["labels"]]
-            coords, labels = unzip([ScenePreprocessor.filter_out_scene(coord, label) for coord, label in zip(coords, labels)])
-            labels = [ScenePreprocessor.one_hot_encode(label) for label in labels]
-            accumulated_coords, accumulated_labels = ScenePreprocessor.accumulate_voxel(coords, labels, voxel_size)
-            accumulated_coords = accumulated_coords.astype(np.float64)
+            if preprocess_configs.get("num_workers", 1) > 1:
+                # Fork the workers now, before the renderer, encoder and streaming threads start
+                preprocessor = ParallelPreprocessor(loader, preprocess_configs, verbose=verbose and not streaming)
+                preprocessor.open()
+                frames = preprocessor.preprocess_scenes(nframe)
             
-            tracking_boxes = scene_data["tracking_boxes"]
-            tracking_ids = ScenePreprocessor.get_tracking_ids(accumulated_coords, tracking_boxes)
+            else:
+                frames = preprocess_scenes(loader, preprocess_configs, 0, nframe, verbose=verbose and not streaming)
             
-            intrinsic = scene_data["camera_intrinsic"][0]
-            camera_poses = scene_data["camera_extrinsic"]
+            if frame_cache is not None:
+                frames = frame_cache.write_frames(frames, max_frames=len(loader.sample_tokens))
+        
+        trajectory = create_trajectory(frames, visualizer_configs)
+        
+        if visualizer_configs.get("culling", False):
+            # Only build geometry for voxels some view can see
+            trajectory = cull_trajectory(trajectory, visualizer_configs)
+        
+        # Windows the trajectory holds, labelling the render and encode events of the profiler like the preprocessing ones
+        frame_indices = range(0, nframe, window_stride)
+        
+        if streaming:
+            # Load -> preprocess -> wrap up -> render one frame at a time with bounded queues between the stages
+            queue_size = preprocess_configs.get("queue_size", 4)
             
-            trajectory_element = ScenePreprocessor.create_trajectory(
-                coord=accumulated_coords,
-                label=accumulated_labels,
-                extrinsic=camera_poses[0],
-                intrinsic=intrinsic,
-                tracking_ids=tracking_ids,
-                visualization_type=visualizer_configs["camera_view"],
-                height=visualizer_configs["BEV_height"]
+            trajectory = threaded_generator(trajectory, maxsize=queue_size)
+            wraped_up_scenes = threaded_generator(
+                (visualizer.wrapup_scene(trajectory_element, voxel_size, frame_index=frame_index) for frame_index, trajectory_element in zip(frame_indices, trajectory)),
+                maxsize=queue_size
             )
+            visualizer.visualize(wraped_up_scenes, voxel_size, total=len(frame_indices))
+        
+        else:
+            trajectory = list(trajectory)
+            wraped_up_scenes = visualizer.wrapup_scenes(trajectory, voxel_size, frame_indices=frame_indices)
+            visualizer.visualize(wraped_up_scenes, voxel_size)
+    
+    finally:
+        # Stop the streaming threads from the last stage back, then the workers and the prefetcher, also on errors
+        for generator in (wraped_up_scenes, trajectory):
+            if hasattr(generator, "close"):
+                generator.close()
+        
+        if preprocessor is not None:
+            preprocessor.close()
+        
+        if loader is not None and is_loader_owned:
+            loader.close()
+    
+    if profile_path is not None:
+        profiler.write(profile_path)
+        print(profiler.summary())
+        print(f"Profile saved at {profile_path}")
 
-            trajectory.append(trajectory_element)
+def run_preview(loader_configs, preprocess_configs, visualizer_configs, time_budget=None, fps=None, full_quality=False, verbose=False):
+    """
+    Render a preview at the finest level fitting a time budget or an fps goal, then optionally the full quality clip
+    with the loader of the preview, so sample metadata is resolved once.
+    """
+    loader = Loader(configs=loader_configs, verbose=verbose, window_stride=preprocess_configs.get("window_stride", 1))
+    
+    try:
+        planner = PreviewPlanner(loader, loader_configs, preprocess_configs, visualizer_configs, verbose=verbose)
+        level, preview_loader_configs, preview_preprocess_configs, preview_visualizer_configs, report = planner.plan(time_budget=time_budget, fps=fps)
+        print(planner.describe(level, report))
+        
+        preview_loader = planner.make_loader(preview_loader_configs, preview_preprocess_configs)
+        try:
+            main(
+                loader_configs=preview_loader_configs,
+                preprocess_configs=preview_preprocess_configs,
+                visualizer_configs=preview_visualizer_configs,
+                verbose=verbose,
+                loader=preview_loader
+            )
+        
+        finally:
+            preview_loader.close()
+        
+        if full_quality:
+            main(
+                loader_configs=loader_configs,
+                preprocess_configs=preprocess_configs,
+                visualizer_configs=visualizer_configs,
+                verbose=verbose,
+                loader=loader
+            )
     
-    wraped_up_scenes = visualizer.wrapup_scenes(trajectory, voxel_size)
-    visualizer.visualize(wraped_up_scenes, voxel_size)
+    finally:
+        loader.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Visualize panoptic segmentation results")
     parser.add_argument("--verbose", type=bool, default=True, help="Whether to print debug information")
-    parser.add_argument("--loader_config_path", type=str, default="/root/panoptic_visualizer/configs/loader_configs.yaml", help="Path to the loader config file")
-    parser.add_argument("--preprocess_config_path", type=str, default="/root/panoptic_visualizer/configs/preprocess_configs.yaml", help="Path to the preprocess config file")
-    parser.add_argument("--visualizer_config_path", type=str, default="/root/panoptic_visualizer/configs/visualizer_configs.yaml", help="Path to the visualizer config file")
+    parser.add_argument("--loader_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "loader_configs.yaml"), help="Path to the loader config file")
+    parser.add_argument("--preprocess_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "preprocess_configs.yaml"), help="Path to the preprocess config file")
+    parser.add_argument("--visualizer_config_path", type=str, default=osp.join(CONFIG_DIRECTORY, "visualizer_configs.yaml"), help="Path to the visualizer config file")
+    parser.add_argument("--profile_path", type=str, default=None, help="Path to write a Chrome trace of the pipeline stages to")
+    parser.add_argument("--preview_budget", type=float, default=None, help="Render a preview within this many seconds instead")
+    parser.add_argument("--preview_fps", type=float, default=None, help="Render a preview at this many frames per second instead")
+    parser.add_argument("--full_after_preview", action="store_true", help="Render the full quality clip after the preview, reusing its loader")
     args = parser.parse_args()
     
     verbose = args.verbose
@@ -79,9 +172,22 @@ if __name__ == "__main__":
     preprocess_configs = yaml.load(open(args.preprocess_config_path, "r"), Loader=yaml.FullLoader)
     visualizer_configs = yaml.load(open(args.visualizer_config_path, "r"), Loader=yaml.FullLoader)
     
-    main(
-        loader_configs=loader_configs,
-        preprocess_configs=preprocess_configs,
-        visualizer_configs=visualizer_configs,
-        verbose=verbose
-    )
+    if args.preview_budget is not None or args.preview_fps is not None:
+        run_preview(
+            loader_configs=loader_configs,
+            preprocess_configs=preprocess_configs,
+            visualizer_configs=visualizer_configs,
+            time_budget=args.preview_budget,
+            fps=args.preview_fps,
+            full_quality=args.full_after_preview,
+            verbose=verbose
+        )
+
+    else:
+        main(
+            loader_configs=loader_configs,
+            preprocess_configs=preprocess_configs,
+            visualizer_configs=visualizer_configs,
+            verbose=verbose,
+            profile_path=args.profile_path
+        )
@@ -1,28 +1,57 @@
 import numpy as np
-import torch
-import MinkowskiEngine as ME
+from collections import OrderedDict
 from utils import convert_quaternion_to_rotation_matrix
 
+try:
+    import torch
+except ImportError:  # torch is only needed by the "minkowski" voxel backend
+    torch = None
+
+try:
+    import MinkowskiEngine as ME
+except ImportError:  # MinkowskiEngine is only needed by the "minkowski" voxel backend
+    ME = None
+
 NUMBER_OF_NUSCENES_LABEL_TYPES = 32
+VOXEL_KEY_BITS = 21  # Bits per axis of a packed voxel key
+VOXEL_KEY_OFFSET = 1 << (VOXEL_KEY_BITS - 1)  # Shift signed voxel indices to non-negative values
+VOXEL_KEY_MASK = (1 << VOXEL_KEY_BITS) - 1
 
 
 class ScenePreprocessor:    
 
-    @staticmethod
-    def filter_out_scene(coords, labels):
-        is_valid = (labels != 0)  # Filter out invalid labels
-        valid_coords, valid_labels = coords[is_valid], labels[is_valid]  # Filter out invalid coords
-    
-        return valid_coords, valid_labels
-    
     @staticmethod
     def one_hot_encode(label):
         return torch.nn.functional.one_hot(label.long(), NUMBER_OF_NUSCENES_LABEL_TYPES).float()
     
     @staticmethod
-    def accumulate_voxel(coords, labels, voxel_size):  # sequence_of_labels
-        concatenated_coords = torch.cat(coords, dim=0)
-        concatenated_labels = torch.cat(labels, dim=0)
+    def accumulate_voxel(coords, labels, voxel_size, backend="minkowski"):
+        """
+        Quantize the concatenated scenes into voxels and take the majority label of each voxel.
+        Args:
+            coords: List of Nx3 coordinates.
+            labels: List of N integer labels.
+            voxel_size: Voxel size.
+            backend: "minkowski" (MinkowskiEngine sparse tensor) or "numpy" (packed keys, CPU only).
+        Returns:
+            Accumulated voxel coordinates and their majority labels.
+        """
+        if backend == "minkowski":
+            return ScenePreprocessor.accumulate_voxel_minkowski(coords, labels, voxel_size)
+        
+        elif backend == "numpy":
+            return ScenePreprocessor.accumulate_voxel_numpy(coords, labels, voxel_size)
+        
+        else:
+            raise ValueError(f"Invalid voxel backend: {backend}")
+    
+    @staticmethod
+    def accumulate_voxel_minkowski(coords, labels, voxel_size):
+        if ME is None:
+            raise ImportError("MinkowskiEngine is required by the minkowski voxel backend, use the numpy backend instead")
+        
+        concatenated_coords = torch.cat([torch.as_tensor(coord) for coord in coords], dim=0)
+        concatenated_labels = torch.cat([ScenePreprocessor.one_hot_encode(torch.as_tensor(label)) for label in labels], dim=0)
 
         quantized_scene = ME.SparseTensor(
             features=concatenated_labels,
@@ -40,6 +69,61 @@ class ScenePreprocessor:
         
         return accumulated_coord, accumulated_label
     
+    @staticmethod
+    def accumulate_voxel_numpy(coords, labels, voxel_size):
+        concatenated_coords = np.concatenate([np.asarray(coord)[:, :3] for coord in coords], axis=0)
+        concatenated_labels = np.concatenate([np.asarray(label).astype(np.uint8) for label in labels], axis=0)
+        
+        keys = ScenePreprocessor.pack_voxel_keys(ScenePreprocessor.quantize(concatenated_coords, voxel_size))
+        
+        # Sort points by (voxel, label) and count the runs of identical pairs
+        order = np.lexsort((concatenated_labels, keys))
+        keys, concatenated_labels = keys[order], concatenated_labels[order]
+        
+        is_run_start = np.ones(keys.shape[0], dtype=bool)
+        is_run_start[1:] = (keys[1:] != keys[:-1]) | (concatenated_labels[1:] != concatenated_labels[:-1])
+        run_starts = np.flatnonzero(is_run_start)
+        run_keys, run_labels = keys[run_starts], concatenated_labels[run_starts]
+        run_counts = np.diff(np.append(run_starts, keys.shape[0]))
+        
+        # Majority label per voxel, ties go to the smallest label like argmax over one-hot sums
+        order = np.lexsort((run_labels, -run_counts, run_keys))
+        run_keys, run_labels = run_keys[order], run_labels[order]
+        
+        is_voxel_start = np.ones(run_keys.shape[0], dtype=bool)
+        is_voxel_start[1:] = run_keys[1:] != run_keys[:-1]
+        
+        accumulated_coord = ScenePreprocessor.unpack_voxel_keys(run_keys[is_voxel_start]) * voxel_size
+        accumulated_label = run_labels[is_voxel_start].astype(np.int64)
+        
+        return accumulated_coord, accumulated_label
+    
+    @staticmethod
+    def quantize(coords, voxel_size):
+        return np.floor(np.asarray(coords)[:, :3] / voxel_size).astype(np.int64)
+    
+    @staticmethod
+    def pack_voxel_keys(voxel_indices):
+        """
+        Pack integer voxel indices into one int64 key per voxel.
+        Args:
+            voxel_indices: Nx3 integer voxel indices, each within [-2^20, 2^20).
+        Returns:
+            N int64 keys. Sorting keys sorts voxels lexicographically by (x, y, z).
+        """
+        shifted = voxel_indices.astype(np.int64) + VOXEL_KEY_OFFSET
+        
+        return (shifted[:, 0] << (2 * VOXEL_KEY_BITS)) | (shifted[:, 1] << VOXEL_KEY_BITS) | shifted[:, 2]
+    
+    @staticmethod
+    def unpack_voxel_keys(keys):
+        voxel_indices = np.empty((keys.shape[0], 3), dtype=np.int64)
+        voxel_indices[:, 0] = (keys >> (2 * VOXEL_KEY_BITS)) & VOXEL_KEY_MASK
+        voxel_indices[:, 1] = (keys >> VOXEL_KEY_BITS) & VOXEL_KEY_MASK
+        voxel_indices[:, 2] = keys & VOXEL_KEY_MASK
+        
+        return voxel_indices - VOXEL_KEY_OFFSET
+    
     @staticmethod
     def transform_to_fpv_pose(extrinsic, height):
         extrinsic[:3, :3] = np.array(  # OpenGL convention: flip y and z axis
@@ -71,62 +155,372 @@ class ScenePreprocessor:
         return extrinsic
     
     @staticmethod
-    def get_tracking_ids(coords, tracking_boxes):
+    def build_bev_grid_index(coords, grid_size):
+        """
+        Bucket coords into a bird eye view grid.
+        Args:
+            coords: Nx3 coordinates.
+            grid_size: Edge length of a grid cell.
+        Returns:
+            Dict with the point order sorted by cell, the sorted cell keys, the grid origin and shape.
+        """
+        cells = np.floor(coords[:, :2] / grid_size).astype(np.int64)
+        origin = cells.min(axis=0)
+        cells -= origin
+        shape = cells.max(axis=0) + 1
+        
+        cell_keys = cells[:, 0] * shape[1] + cells[:, 1]
+        order = np.argsort(cell_keys, kind="stable")
+        
+        return {
+            "order": order,
+            "cell_keys": cell_keys[order],
+            "origin": origin,
+            "shape": shape,
+        }
+    
+    @staticmethod
+    def get_tracking_ids(coords, tracking_boxes, grid_size=2.0):
+        """
+        Annotate coords with the tracking id of the box containing them.
+        Args:
+            coords: Nx3 coordinates.
+            tracking_boxes: List of tracking boxes per frame of the window.
+            grid_size: Cell size of the bird eye view index used to find the coords near each box.
+        Returns:
+            N int32 indices into the tracking id table (-1 outside every box) and the tracking id table.
+        """
         tracking_ids = np.full((coords.shape[0],), -1, dtype=np.int32)
         int_mapping = {}
-        reverse_mapping = {}
-
+        
         _tracking_boxes = []
         for tracking_boxes_for_one_frame in tracking_boxes:
             _tracking_boxes.extend(tracking_boxes_for_one_frame)
         
-        # Annotate coords with tracking ids
-        for tracking_box in _tracking_boxes:
-            
-            translation = tracking_box.translation
-            rotation = convert_quaternion_to_rotation_matrix(tracking_box.rotation)
-            size = tracking_box.size
-            tracking_id = tracking_box.tracking_id
-            
-            if tracking_id not in int_mapping.keys():
-                int_mapping[tracking_id] = len(int_mapping)
-            
-            translated_coords = coords[:, :3] - translation
-            rotated_coords = translated_coords @ rotation.T
-            is_x = (-size[0] / 2 <= rotated_coords[:, 0]) & (rotated_coords[:, 0] <= size[0] / 2)
-            is_y = (-size[1] / 2 <= rotated_coords[:, 1]) & (rotated_coords[:, 1] <= size[1] / 2)
-            is_z = (-size[2] / 2 <= rotated_coords[:, 2]) & (rotated_coords[:, 2] <= size[2] / 2)
-            is_inside = is_x & is_y & is_z
+        translations = np.zeros((len(_tracking_boxes), 3))
+        rotations = np.zeros((len(_tracking_boxes), 3, 3))
+        half_sizes = np.zeros((len(_tracking_boxes), 3))
+        box_ids = np.zeros((len(_tracking_boxes),), dtype=np.int32)
+        
+        for i, tracking_box in enumerate(_tracking_boxes):
+            if tracking_box.tracking_id not in int_mapping:
+                int_mapping[tracking_box.tracking_id] = len(int_mapping)
             
-            tracking_ids[is_inside] = int_mapping[tracking_id]
-            reverse_mapping[int_mapping[tracking_id]] = tracking_id
+            translations[i] = tracking_box.translation
+            rotations[i] = convert_quaternion_to_rotation_matrix(tracking_box.rotation)
+            half_sizes[i] = np.asarray(tracking_box.size) / 2
+            box_ids[i] = int_mapping[tracking_box.tracking_id]
+        
+        tracking_id_table = list(int_mapping.keys())
+        
+        if coords.shape[0] == 0 or len(_tracking_boxes) == 0:
+            return tracking_ids, tracking_id_table
+        
+        coords = coords[:, :3]
+        grid_index = ScenePreprocessor.build_bev_grid_index(coords, grid_size)
+        shape = grid_index["shape"]
+        
+        # Axis aligned bounding box of every rotated box, in grid cells
+        half_extents = np.einsum("bji,bj->bi", np.abs(rotations), half_sizes)
+        cell_min = np.floor((translations[:, :2] - half_extents[:, :2]) / grid_size).astype(np.int64) - grid_index["origin"]
+        cell_max = np.floor((translations[:, :2] + half_extents[:, :2]) / grid_size).astype(np.int64) - grid_index["origin"]
+        cell_min, cell_max = np.maximum(cell_min, 0), np.minimum(cell_max, shape - 1)
+        
+        # One (box, grid row) pair per row a box overlaps, each covering a contiguous run of cell keys
+        number_of_rows = np.where((cell_min <= cell_max).all(axis=1), cell_max[:, 0] - cell_min[:, 0] + 1, 0)
+        pair_box = np.repeat(np.arange(len(_tracking_boxes)), number_of_rows)
+        pair_row = cell_min[pair_box, 0] + np.arange(pair_box.shape[0]) - np.repeat(np.cumsum(number_of_rows) - number_of_rows, number_of_rows)
+        
+        start = np.searchsorted(grid_index["cell_keys"], pair_row * shape[1] + cell_min[pair_box, 1], side="left")
+        stop = np.searchsorted(grid_index["cell_keys"], pair_row * shape[1] + cell_max[pair_box, 1], side="right")
         
-        tracking_ids = [reverse_mapping[i] if i != -1 else "" for i in tracking_ids ]
+        # Candidate (point, box) pairs
+        number_of_candidates = stop - start
+        candidate_pair = np.repeat(np.arange(pair_box.shape[0]), number_of_candidates)
+        candidate_position = start[candidate_pair] + np.arange(candidate_pair.shape[0]) - np.repeat(np.cumsum(number_of_candidates) - number_of_candidates, number_of_candidates)
+        candidate_point = grid_index["order"][candidate_position]
+        candidate_box = pair_box[candidate_pair]
         
-        for _ in tracking_ids:
-            if _ != "":
-                print(_)
-        return tracking_ids
+        # Rotated box containment
+        rotated_coords = np.einsum("nij,nj->ni", rotations[candidate_box], coords[candidate_point] - translations[candidate_box])
+        is_inside = (np.abs(rotated_coords) <= half_sizes[candidate_box]).all(axis=1)
+        candidate_point, candidate_box = candidate_point[is_inside], candidate_box[is_inside]
+        
+        # Later boxes take precedence when boxes overlap
+        order = np.lexsort((-candidate_box, candidate_point))
+        candidate_point, candidate_box = candidate_point[order], candidate_box[order]
+        is_first = np.ones(candidate_point.shape[0], dtype=bool)
+        is_first[1:] = candidate_point[1:] != candidate_point[:-1]
+        
+        tracking_ids[candidate_point[is_first]] = box_ids[candidate_box[is_first]]
+        
+        return tracking_ids, tracking_id_table
     
     @staticmethod
-    def create_trajectory(coord, label, extrinsic, intrinsic, tracking_ids, visualization_type, height):
+    def create_trajectory(frame, visualization_type, height, resolution=None, intrinsic_scale=1.0):
         if visualization_type == "FPV":
             transform_pose = ScenePreprocessor.transform_to_fpv_pose
             
         elif visualization_type == "BEV":
             transform_pose = ScenePreprocessor.transform_to_bev_pose
         
+        elif visualization_type in frame.views:  # Camera channel, rendered from the pose of the camera itself
+            view = frame.views[visualization_type]
+            intrinsic = np.asarray(view["intrinsic"], dtype=np.float64)
+            
+            if resolution is not None:
+                intrinsic = ScenePreprocessor.scale_intrinsic(intrinsic, view["image_size"], resolution)
+            
+            return frame.replace(extrinsic=np.asarray(view["extrinsic"], dtype=np.float64), intrinsic=intrinsic)
+        
         else:
             raise ValueError(f"Invalid visualization type: {visualization_type}")
         
-        extrinsic = transform_pose(extrinsic, height)
+        extrinsic = transform_pose(np.copy(frame.extrinsic), height)
         
-        trajectory = {
-            "coord": coord,
-            "label": label,
-            "extrinsic": extrinsic,
-            "intrinsic": intrinsic,
-            "tracking_ids": tracking_ids,
-        }
+        if intrinsic_scale != 1.0:  # Keep the framing at a reduced resolution
+            return frame.replace(extrinsic=extrinsic, intrinsic=frame.intrinsic * np.array([intrinsic_scale, intrinsic_scale, 1.0])[:, None])
+        
+        return frame.replace(extrinsic=extrinsic)
+    
+    @staticmethod
+    def scale_intrinsic(intrinsic, image_size, resolution):
+        """
+        Scale an intrinsic matrix from the native image size of a camera to the render resolution.
+        Args:
+            intrinsic: 3x3 intrinsic matrix.
+            image_size: Native (width, height).
+            resolution: Render (width, height).
+        Returns:
+            Scaled 3x3 intrinsic matrix.
+        """
+        scale = np.array([resolution[0] / image_size[0], resolution[1] / image_size[1], 1.0])
+        
+        return intrinsic * scale[:, None]
+    
+    @staticmethod
+    def get_camera_center(extrinsic):
+        """
+        Position of a camera in the world from its world to camera extrinsic.
+        """
+        return -extrinsic[:3, :3].T @ extrinsic[:3, 3]
+    
+    @staticmethod
+    def get_visible_mask(coord, voxel_size, intrinsic, extrinsic, resolution, near=0.1, margin=0.1, max_distance=None):
+        """
+        Conservatively test which voxels may be seen by a pinhole camera.
+        A voxel is kept when its bounding sphere is in front of the near plane and its projection is inside the image
+        grown by a margin.
+        Args:
+            coord: Nx3 voxel coordinates.
+            voxel_size: Voxel edge length, a scalar or one per voxel.
+            intrinsic: 3x3 intrinsic matrix.
+            extrinsic: 4x4 world to camera extrinsic matrix.
+            resolution: Image (width, height).
+            near: Near plane distance.
+            margin: Margin on every side of the image, as a fraction of its size.
+            max_distance: Optional distance from the camera beyond which voxels are dropped.
+        Returns:
+            N boolean mask.
+        """
+        width, height = resolution
+        
+        camera_coords = coord @ extrinsic[:3, :3].T + extrinsic[:3, 3]
+        depth = camera_coords[:, 2]
+        radius = np.sqrt(3) / 2 * voxel_size  # Bounding sphere of a voxel
+        
+        is_visible = depth > near - radius
+        if max_distance is not None:
+            is_visible &= np.linalg.norm(camera_coords, axis=1) <= max_distance + radius
+        
+        # Voxels crossing the near plane are projected from it, which only grows their footprint
+        projection_depth = np.maximum(depth, near)
+        u = intrinsic[0, 0] * camera_coords[:, 0] / projection_depth + intrinsic[0, 2]
+        v = intrinsic[1, 1] * camera_coords[:, 1] / projection_depth + intrinsic[1, 2]
+        u_margin = intrinsic[0, 0] * radius / projection_depth + margin * width
+        v_margin = intrinsic[1, 1] * radius / projection_depth + margin * height
+        
+        is_visible &= (u >= -u_margin) & (u <= width + u_margin) & (v >= -v_margin) & (v <= height + v_margin)
+        
+        return is_visible
+    
+    @staticmethod
+    def select_voxels(frame, mask):
+        """
+        Copy of a frame keeping the voxels of a boolean mask.
+        """
+        return frame.replace(
+            voxel_indices=frame.voxel_indices[mask],
+            label=frame.label[mask],
+            tracking_ids=frame.tracking_ids[mask],
+            voxel_scale=frame.voxel_scale[mask] if frame.voxel_scale is not None else None
+        )
+    
+    @staticmethod
+    def merge_lod(frame, camera_centers, lod_bands):
+        """
+        Merge voxels far from every camera into coarser cells of the majority label.
+        Cells of a band are aligned to a grid of its scale, so cells of nested scales never overlap and stay in place
+        while the window slides. A cell is merged when its center is beyond the band distance.
+        Args:
+            frame: Frame without level-of-detail scales.
+            camera_centers: Cx3 camera positions.
+            lod_bands: List of (distance, scale), scale being the cell edge in voxels. Every scale must divide the next one.
+        Returns:
+            Frame with voxel_scale set. Merged cells have no tracking id.
+        """
+        lod_bands = sorted((distance, int(scale)) for distance, scale in lod_bands)
+        for (_, scale), (_, next_scale) in zip(lod_bands[:-1], lod_bands[1:]):
+            if next_scale % scale != 0:
+                raise ValueError(f"LOD scale {next_scale} is not a multiple of {scale}")
+        
+        voxel_indices = frame.voxel_indices + frame.origin_index  # Align cells across frames
+        labels = np.asarray(frame.label)
+        is_fine = np.ones(voxel_indices.shape[0], dtype=bool)
+        
+        list_of_indices, list_of_label, list_of_scale = [], [], []
+        for distance, scale in reversed(lod_bands):  # Coarsest band first
+            fine = np.flatnonzero(is_fine)
+            cell_indices = np.floor_divide(voxel_indices[fine], scale)
+            cell_centers = (cell_indices * scale + (scale - 1) / 2) * frame.voxel_size
+            cell_distance = np.min(np.linalg.norm(cell_centers[:, None, :] - camera_centers[None, :, :], axis=-1), axis=1)
+            
+            is_merged = cell_distance >= distance
+            if not is_merged.any():
+                continue
+            
+            merged_cells, merged_labels = ScenePreprocessor.accumulate_voxel_numpy([cell_indices[is_merged]], [labels[fine[is_merged]]], 1.0)
+            list_of_indices.append(merged_cells.astype(np.int64) * scale)
+            list_of_label.append(merged_labels)
+            list_of_scale.append(np.full(merged_labels.shape[0], scale, dtype=np.uint8))
+            is_fine[fine[is_merged]] = False
+        
+        number_of_cells = sum(label.shape[0] for label in list_of_label)
+        
+        return frame.replace(
+            voxel_indices=(np.concatenate([voxel_indices[is_fine]] + list_of_indices) - frame.origin_index).astype(np.int32),
+            label=np.concatenate([labels[is_fine]] + list_of_label).astype(np.uint8),
+            tracking_ids=np.concatenate([frame.tracking_ids[is_fine], np.full(number_of_cells, -1, dtype=np.int32)]),
+            voxel_scale=np.concatenate([np.ones(int(is_fine.sum()), dtype=np.uint8)] + list_of_scale)
+        )
+
+
+class VoxelAccumulator:
+    """
+    Sliding-window voxel accumulator.
+    Keeps voxel -> per-class point counts for every sweep in the window, so moving the window
+    only adds the sweep entering it and subtracts the one leaving it instead of re-quantizing
+    every point of the window.
+    Counts live in rows (slots) that stay put while their voxel is in the window, so a slide only touches the rows of
+    the two sweeps and the majority label is only recomputed for those rows.
+    """
+    def __init__(self, voxel_size, initial_capacity=1 << 16):
+        self.voxel_size = voxel_size
+        
+        self.sweeps = OrderedDict()  # Ring buffer: sweep id -> (keys, slots, counts, totals)
+        self.keys = np.empty((0,), dtype=np.int64)  # Sorted voxel keys in the window
+        self.key_slots = np.empty((0,), dtype=np.int64)  # Slot of every key
+        
+        self.counts = np.zeros((initial_capacity, NUMBER_OF_NUSCENES_LABEL_TYPES), dtype=np.int32)
+        self.totals = np.zeros((initial_capacity,), dtype=np.int64)  # Points of every slot, 0 for free slots
+        self.labels = np.zeros((initial_capacity,), dtype=np.int64)  # Majority label of every slot
+        self.voxel_indices = np.zeros((initial_capacity, 3), dtype=np.int64)  # Voxel of every slot
+        self.free_slots = np.arange(initial_capacity, dtype=np.int64)[::-1]  # Stack, popped from the end
+        self.dirty_slots = []  # Slots touched since the labels were last updated
+    
+    def count_sweep(self, coords, labels):
+        keys = ScenePreprocessor.pack_voxel_keys(ScenePreprocessor.quantize(coords, self.voxel_size))
+        labels = np.asarray(labels).astype(np.int64)
+        
+        sweep_keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(
+            inverse.reshape(-1) * NUMBER_OF_NUSCENES_LABEL_TYPES + labels,
+            minlength=sweep_keys.shape[0] * NUMBER_OF_NUSCENES_LABEL_TYPES
+        ).astype(np.int32).reshape(-1, NUMBER_OF_NUSCENES_LABEL_TYPES)
+        
+        return sweep_keys, counts
+    
+    def allocate_slots(self, number_of_slots):
+        if number_of_slots > self.free_slots.shape[0]:
+            # Double the capacity, the new slots go below the free ones so they are used last
+            capacity = self.counts.shape[0]
+            new_capacity = max(2 * capacity, capacity + number_of_slots - self.free_slots.shape[0])
+            
+            self.counts = np.concatenate([self.counts, np.zeros((new_capacity - capacity, NUMBER_OF_NUSCENES_LABEL_TYPES), dtype=np.int32)])
+            self.totals = np.concatenate([self.totals, np.zeros((new_capacity - capacity,), dtype=np.int64)])
+            self.labels = np.concatenate([self.labels, np.zeros((new_capacity - capacity,), dtype=np.int64)])
+            self.voxel_indices = np.concatenate([self.voxel_indices, np.zeros((new_capacity - capacity, 3), dtype=np.int64)])
+            self.free_slots = np.concatenate([np.arange(capacity, new_capacity, dtype=np.int64)[::-1], self.free_slots])
+        
+        slots = self.free_slots[self.free_slots.shape[0] - number_of_slots:]
+        self.free_slots = self.free_slots[:self.free_slots.shape[0] - number_of_slots]
+        
+        return slots
+    
+    def add_sweep(self, sweep_id, coords, labels):
+        keys, counts = self.count_sweep(coords, labels)
+        
+        position = np.searchsorted(self.keys, keys)
+        is_existing = position < self.keys.shape[0]
+        is_existing[is_existing] = self.keys[position[is_existing]] == keys[is_existing]
         
-        return trajectory
+        is_new = ~is_existing
+        slots = np.empty(keys.shape[0], dtype=np.int64)
+        slots[is_existing] = self.key_slots[position[is_existing]]
+        slots[is_new] = self.allocate_slots(int(is_new.sum()))
+        self.voxel_indices[slots[is_new]] = ScenePreprocessor.unpack_voxel_keys(keys[is_new])
+        
+        totals = counts.sum(axis=1)
+        self.counts[slots] += counts  # Keys of a sweep are unique, so are their slots
+        self.totals[slots] += totals
+        self.dirty_slots.append(slots)
+        self.sweeps[sweep_id] = (keys, slots, counts, totals)
+        
+        # Only the 1D key index is shifted, the count rows stay in place
+        self.keys = np.insert(self.keys, position[is_new], keys[is_new])
+        self.key_slots = np.insert(self.key_slots, position[is_new], slots[is_new])
+    
+    def remove_sweep(self, sweep_id):
+        keys, slots, counts, totals = self.sweeps.pop(sweep_id)
+        
+        self.counts[slots] -= counts
+        self.totals[slots] -= totals
+        self.dirty_slots.append(slots)
+        
+        is_empty = self.totals[slots] == 0
+        self.free_slots = np.concatenate([self.free_slots, slots[is_empty]])
+        
+        position = np.searchsorted(self.keys, keys[is_empty])  # Every key of the sweep is in the window
+        self.keys = np.delete(self.keys, position)
+        self.key_slots = np.delete(self.key_slots, position)
+    
+    def update(self, sweep_ids, coords, labels):
+        """
+        Slide the window to the given sweeps.
+        Args:
+            sweep_ids: Ids (e.g. lidar tokens) of the sweeps in the new window.
+            coords: List of Nx3 coordinates, one per sweep.
+            labels: List of N labels, one per sweep.
+        Returns:
+            Accumulated voxel coordinates and their majority labels.
+        """
+        for sweep_id in [sweep_id for sweep_id in self.sweeps.keys() if sweep_id not in sweep_ids]:
+            self.remove_sweep(sweep_id)
+        
+        for sweep_id, coord, label in zip(sweep_ids, coords, labels):
+            if sweep_id not in self.sweeps:
+                self.add_sweep(sweep_id, coord, label)
+        
+        return self.emit()
+    
+    def emit(self):
+        if self.dirty_slots:
+            # Ties go to the smallest label, like argmax over the whole count matrix
+            dirty_slots = np.concatenate(self.dirty_slots)  # Slots touched twice are recomputed twice, cheaper than deduplicating
+            self.labels[dirty_slots] = np.take(self.counts, dirty_slots, axis=0).argmax(axis=-1)
+            self.dirty_slots = []
+        
+        accumulated_coord = np.take(self.voxel_indices, self.key_slots, axis=0) * self.voxel_size
+        accumulated_label = np.take(self.labels, self.key_slots)
+        
+        return accumulated_coord, accumulated_label
@@ -0,0 +1,42 @@
+import sys
+import numpy as np
+import pytest
+import os.path as osp
+
+# Modules live at the repository root
+sys.path.insert(0, osp.dirname(osp.dirname(osp.abspath(__file__))))
+
+from scene_preprocessor import NUMBER_OF_NUSCENES_LABEL_TYPES
+
+
+@pytest.fixture
+def make_sweeps():
+    def make(number_of_sweeps, number_of_points, seed=0):
+        """
+        Random sweeps drifting along x, overlapping enough that voxels are shared across sweeps.
+        """
+        rng = np.random.default_rng(seed)
+        
+        sweeps = []
+        for i in range(number_of_sweeps):
+            coords = rng.uniform([-10, -10, -2], [10, 10, 2], size=(number_of_points, 3)) + [0.5 * i, 0, 0]
+            labels = rng.integers(1, NUMBER_OF_NUSCENES_LABEL_TYPES, size=number_of_points).astype(np.uint8)
+            sweeps.append((coords, labels))
+        
+        return sweeps
+    
+    return make
+
+
+@pytest.fixture
+def sort_voxels():
+    def sort(coord, label, voxel_size):
+        """
+        Integer voxel indices and labels in (x, y, z) order, to compare voxelizations regardless of their output order.
+        """
+        voxel_indices = np.round(np.asarray(coord) / voxel_size).astype(np.int64)
+        order = np.lexsort(voxel_indices.T[::-1])
+        
+        return voxel_indices[order], np.asarray(label)[order]
+    
+    return sort
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+from scene_preprocessor import ScenePreprocessor, NUMBER_OF_NUSCENES_LABEL_TYPES
+
+VOXEL_SIZE = 0.2
+
+
+def accumulate_voxel_reference(coords, labels, voxel_size):
+    # Per-voxel class histograms with bincount, majority label with argmax
+    voxel_indices = np.floor(np.concatenate(coords) / voxel_size).astype(np.int64)
+    labels = np.concatenate(labels).astype(np.int64)
+    
+    unique_indices, inverse = np.unique(voxel_indices, axis=0, return_inverse=True)
+    counts = np.bincount(
+        inverse.reshape(-1) * NUMBER_OF_NUSCENES_LABEL_TYPES + labels,
+        minlength=unique_indices.shape[0] * NUMBER_OF_NUSCENES_LABEL_TYPES
+    ).reshape(-1, NUMBER_OF_NUSCENES_LABEL_TYPES)
+    
+    return unique_indices, counts.argmax(axis=-1)
+
+
+def test_accumulate_voxel_numpy_matches_reference(make_sweeps, sort_voxels):
+    sweeps = make_sweeps(5, 20000)
+    coords, labels = [coord for coord, _ in sweeps], [label for _, label in sweeps]
+    
+    voxel_indices, label = sort_voxels(*ScenePreprocessor.accumulate_voxel_numpy(coords, labels, VOXEL_SIZE), VOXEL_SIZE)
+    reference_indices, reference_label = accumulate_voxel_reference(coords, labels, VOXEL_SIZE)
+    
+    np.testing.assert_array_equal(voxel_indices, reference_indices)
+    np.testing.assert_array_equal(label, reference_label)
+
+
+def test_accumulate_voxel_numpy_breaks_ties_to_smallest_label():
+    coords = [np.array([[0.01, 0.01, 0.01], [0.02, 0.02, 0.02], [0.03, 0.03, 0.03], [0.04, 0.04, 0.04]])]
+    labels = [np.array([9, 4, 9, 4], dtype=np.uint8)]
+    
+    _, label = ScenePreprocessor.accumulate_voxel_numpy(coords, labels, VOXEL_SIZE)
+    
+    np.testing.assert_array_equal(label, [4])
+
+
+def test_accumulate_voxel_minkowski_matches_numpy(make_sweeps, sort_voxels):
+    pytest.importorskip("MinkowskiEngine")
+    
+    sweeps = make_sweeps(5, 20000)
+    coords, labels = [coord for coord, _ in sweeps], [label for _, label in sweeps]
+    
+    minkowski_indices, minkowski_label = sort_voxels(*ScenePreprocessor.accumulate_voxel_minkowski(coords, labels, VOXEL_SIZE), VOXEL_SIZE)
+    numpy_indices, numpy_label = sort_voxels(*ScenePreprocessor.accumulate_voxel_numpy(coords, labels, VOXEL_SIZE), VOXEL_SIZE)
+    
+    np.testing.assert_array_equal(minkowski_indices, numpy_indices)
+    np.testing.assert_array_equal(minkowski_label, numpy_label)
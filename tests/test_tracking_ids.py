@@ -0,0 +1,66 @@
+import types
+import numpy as np
+import pytest
+from scene_preprocessor import ScenePreprocessor
+from utils import convert_quaternion_to_rotation_matrix
+
+
+def get_tracking_ids_reference(coords, tracking_boxes):
+    # One pass over every point per box, later boxes overwrite earlier ones
+    tracking_ids = np.full((coords.shape[0],), "", dtype=object)
+    
+    for tracking_box in [tracking_box for tracking_boxes_for_one_frame in tracking_boxes for tracking_box in tracking_boxes_for_one_frame]:
+        rotation = convert_quaternion_to_rotation_matrix(tracking_box.rotation)
+        size = tracking_box.size
+        
+        rotated_coords = (coords[:, :3] - tracking_box.translation) @ rotation.T
+        is_inside = (np.abs(rotated_coords) <= np.asarray(size) / 2).all(axis=1)
+        
+        tracking_ids[is_inside] = tracking_box.tracking_id
+    
+    return tracking_ids
+
+
+def make_tracking_boxes(number_of_frames, number_of_boxes, seed=0):
+    rng = np.random.default_rng(seed)
+    
+    tracking_boxes = []
+    for _ in range(number_of_frames):
+        quaternions = rng.normal(size=(number_of_boxes, 4))
+        quaternions /= np.linalg.norm(quaternions, axis=1, keepdims=True)
+        
+        tracking_boxes.append([
+            types.SimpleNamespace(
+                tracking_id=f"track_{rng.integers(0, number_of_boxes)}",  # Tracks repeat across frames and boxes overlap
+                translation=rng.uniform([-20, -20, -1], [20, 20, 1]),
+                rotation=quaternion,
+                size=rng.uniform([1, 1, 1], [8, 4, 3])
+            )
+            for quaternion in quaternions
+        ])
+    
+    return tracking_boxes
+
+
+@pytest.mark.parametrize("grid_size", [0.5, 2.0, 10.0])
+def test_get_tracking_ids_matches_per_box_loop(grid_size):
+    rng = np.random.default_rng(1)
+    coords = rng.uniform([-25, -25, -2], [25, 25, 2], size=(50000, 3))
+    tracking_boxes = make_tracking_boxes(3, 30)
+    
+    tracking_ids, tracking_id_table = ScenePreprocessor.get_tracking_ids(coords, tracking_boxes, grid_size=grid_size)
+    tracking_ids = np.array([tracking_id_table[i] if i != -1 else "" for i in tracking_ids], dtype=object)
+    
+    reference_tracking_ids = get_tracking_ids_reference(coords, tracking_boxes)
+    
+    assert (reference_tracking_ids != "").any()
+    np.testing.assert_array_equal(tracking_ids, reference_tracking_ids)
+
+
+def test_get_tracking_ids_without_boxes():
+    coords = np.zeros((4, 3))
+    
+    tracking_ids, tracking_id_table = ScenePreprocessor.get_tracking_ids(coords, [[], []])
+    
+    np.testing.assert_array_equal(tracking_ids, [-1, -1, -1, -1])
+    assert tracking_id_table == []
@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+from scene_preprocessor import ScenePreprocessor, VoxelAccumulator
+
+VOXEL_SIZE = 0.2
+
+
+@pytest.mark.parametrize("nsample_per_frame, window_stride", [(5, 1), (20, 1), (5, 3), (5, 8)])
+def test_voxel_accumulator_matches_full_quantization(make_sweeps, sort_voxels, nsample_per_frame, window_stride):
+    sweeps = make_sweeps(40, 5000)
+    voxel_accumulator = VoxelAccumulator(VOXEL_SIZE, initial_capacity=256)  # Small enough to grow while sliding
+    
+    for start in range(0, len(sweeps) - nsample_per_frame + 1, window_stride):
+        sweep_ids = list(range(start, start + nsample_per_frame))
+        coords, labels = [sweeps[i][0] for i in sweep_ids], [sweeps[i][1] for i in sweep_ids]
+        
+        voxel_indices, label = sort_voxels(*voxel_accumulator.update(sweep_ids, coords, labels), VOXEL_SIZE)
+        reference_indices, reference_label = sort_voxels(*ScenePreprocessor.accumulate_voxel_numpy(coords, labels, VOXEL_SIZE), VOXEL_SIZE)
+        
+        np.testing.assert_array_equal(voxel_indices, reference_indices)
+        np.testing.assert_array_equal(label, reference_label)
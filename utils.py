@@ -1,3 +1,5 @@
+import queue
+import threading
 import numpy as np
 
 
@@ -21,3 +23,63 @@ def convert_quaternion_to_rotation_matrix(quaternion):
     ])
     
     return rotation
+
+def threaded_generator(generator, maxsize=4):
+    """
+    Run a generator in a background thread, stopping it when the consumer closes or stops iterating.
+    Args:
+        generator: Generator to run.
+        maxsize: Maximum number of items buffered ahead of the consumer.
+    Yields:
+        Items of the generator, in order.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+    end_of_generator = object()
+    
+    def put(item):
+        # Wait for room in the queue only while the consumer is still there
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            
+            except queue.Full:
+                continue
+        
+        return False
+    
+    def produce():
+        try:
+            for item in generator:
+                if not put((item, None)):
+                    break
+            
+            else:
+                put((end_of_generator, None))
+        
+        except BaseException as exception:  # Re-raised in the consumer
+            put((None, exception))
+        
+        finally:
+            if hasattr(generator, "close"):
+                generator.close()  # Stops upstream threaded generators as well
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    
+    try:
+        while True:
+            item, exception = items.get()
+            
+            if exception is not None:
+                raise exception
+            
+            if item is end_of_generator:
+                break
+            
+            yield item
+    
+    finally:
+        stop.set()
+        thread.join()
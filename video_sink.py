@@ -0,0 +1,194 @@
+import os
+import cv2
+import time
+import queue
+import shlex
+import threading
+import subprocess
+import numpy as np
+import os.path as osp
+from profiler import get_profiler
+
+DEFAULT_PIPE_COMMAND = "ffmpeg -y -loglevel error -f rawvideo -pix_fmt rgb24 -s {width}x{height} -r {fps} -i - -c:v libx264 -pix_fmt yuv420p {output}"
+
+
+class VideoSink:
+    """
+    Interface of the frame sinks. Frames are HxWx3 uint8 RGB arrays.
+    """
+    def write(self, frame):
+        raise NotImplementedError
+    
+    def close(self):
+        pass
+    
+    def describe(self):
+        raise NotImplementedError
+
+
+class CV2VideoSink(VideoSink):
+    def __init__(self, path, codec, fps, resolution):
+        self.path = path
+        self.writer = cv2.VideoWriter(
+            filename=path,
+            fourcc=cv2.VideoWriter_fourcc(*codec),
+            fps=fps,
+            frameSize=tuple(resolution)
+        )
+    
+    def write(self, frame):
+        self.writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))  # OpenCV expects BGR
+    
+    def close(self):
+        self.writer.release()
+    
+    def describe(self):
+        return f"Video saved at {self.path}"
+
+
+class PipeVideoSink(VideoSink):
+    """
+    Stream raw RGB frames into the stdin of an external encoder, e.g. ffmpeg.
+    """
+    def __init__(self, path, fps, resolution, command=DEFAULT_PIPE_COMMAND):
+        self.path = path
+        command = command.format(width=resolution[0], height=resolution[1], fps=fps, output=shlex.quote(path))
+        self.process = subprocess.Popen(shlex.split(command), stdin=subprocess.PIPE)
+    
+    def write(self, frame):
+        self.process.stdin.write(np.ascontiguousarray(frame).tobytes())
+    
+    def close(self):
+        self.process.stdin.close()
+        
+        if self.process.wait() != 0:
+            raise RuntimeError(f"Encoder exited with code {self.process.returncode}")
+    
+    def describe(self):
+        return f"Video saved at {self.path}"
+
+
+class FrameSequenceSink(VideoSink):
+    """
+    Write numbered frames, as PNG images or NPY arrays, into a directory.
+    """
+    def __init__(self, directory, frame_format="png"):
+        if frame_format not in ["png", "npy"]:
+            raise ValueError(f"Invalid frame format: {frame_format}")
+        
+        self.directory = directory
+        self.frame_format = frame_format
+        self.frame_index = 0
+        
+        os.makedirs(directory, exist_ok=True)
+    
+    def write(self, frame):
+        path = osp.join(self.directory, f"{self.frame_index:06d}.{self.frame_format}")
+        
+        if self.frame_format == "png":
+            cv2.imwrite(path, cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+        
+        else:
+            np.save(path, frame)
+        
+        self.frame_index += 1
+    
+    def describe(self):
+        return f"{self.frame_index} frames saved at {self.directory}"
+
+
+def make_sink(configs, output_name=None):
+    """
+    Make the frame sink selected by output_sink in the visualizer configs.
+    Args:
+        configs: Visualizer configs.
+        output_name: Output name overriding the configured one, e.g. one per view.
+    """
+    sink_type = configs.get("output_sink", "cv2")
+    path = osp.join(configs["output_path"], output_name or configs["output_name"])
+    
+    if sink_type == "cv2":
+        return CV2VideoSink(path, configs["output_codec"], configs["fps"], configs["resolution"])
+    
+    elif sink_type == "pipe":
+        return PipeVideoSink(path, configs["fps"], configs["resolution"], configs.get("pipe_command", DEFAULT_PIPE_COMMAND))
+    
+    elif sink_type in ["png", "npy"]:
+        return FrameSequenceSink(osp.splitext(path)[0], frame_format=sink_type)
+    
+    else:
+        raise ValueError(f"Invalid output sink: {sink_type}")
+
+
+class AsyncEncoder:
+    """
+    Encode frames in a dedicated thread fed through a bounded queue, so rendering and encoding overlap.
+    """
+    def __init__(self, sink, queue_size=8):
+        self.sink = sink
+        self.frames = queue.Queue(maxsize=queue_size)
+        self.exception = None
+        
+        # Statistics
+        self.number_of_frames = 0
+        self.encode_time = 0.0
+        self.number_of_stalls = 0
+        self.stall_time = 0.0
+        
+        self.thread = threading.Thread(target=self.encode, daemon=True)
+        self.thread.start()
+    
+    def encode(self):
+        while True:
+            item = self.frames.get()
+            
+            if item is None:
+                break
+            
+            if self.exception is not None:  # Drain the queue after a failure
+                continue
+            
+            frame, frame_index, view = item
+            try:
+                start = time.perf_counter()
+                with get_profiler().stage("encode", frame=frame_index, view=view):
+                    self.sink.write(frame)
+                self.encode_time += time.perf_counter() - start
+                self.number_of_frames += 1
+            
+            except Exception as exception:
+                self.exception = exception
+    
+    def write(self, frame, frame_index=None, view=None):
+        """
+        Queue a frame. frame_index and view label its encode event in the profiler.
+        """
+        if self.exception is not None:
+            raise self.exception
+        
+        item = (frame, frame_index, view)
+        try:
+            self.frames.put_nowait(item)
+        
+        except queue.Full:  # Rendering is ahead of encoding
+            start = time.perf_counter()
+            self.frames.put(item)
+            self.stall_time += time.perf_counter() - start
+            self.number_of_stalls += 1
+    
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.sink.close()
+        
+        if self.exception is not None:
+            raise self.exception
+    
+    def stats(self):
+        return {
+            "frames": self.number_of_frames,
+            "encode_time": self.encode_time,
+            "encode_fps": self.number_of_frames / self.encode_time if self.encode_time > 0 else float("inf"),
+            "stalls": self.number_of_stalls,
+            "stall_time": self.stall_time,
+        }
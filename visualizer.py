@@ -1,9 +1,14 @@
-import cv2
-import os.path as osp
+import itertools
 from tqdm import tqdm
 import open3d as o3d
 import numpy as np
+import cv2
+import os.path as osp
 from nuscenes.utils.color_map import get_colormap
+from renderer import make_renderer, get_default_intrinsic
+from video_sink import make_sink, AsyncEncoder
+from profiler import get_profiler
+from pipeline import get_camera_views
 
 class Visualizer:
     def __init__(self, configs, verbose=False):
@@ -11,6 +16,14 @@ class Visualizer:
         
         self.color_map = self.load_color_map()
         self.verbose = verbose
+        
+        # Rendering backend: "window" and "window_incremental" need a display server, "offscreen" and "numpy" are headless
+        self.renderer = make_renderer(configs.get("renderer", "window"), configs["resolution"], self.color_map)
+        
+        # Every view is rendered from the same geometry, into its own output or tiled into one mosaic
+        self.camera_views = get_camera_views(configs)
+        self.mosaic = configs.get("mosaic", False)
+    
     @staticmethod
     def load_color_map():
         _color_map = get_colormap()
@@ -23,7 +36,10 @@ class Visualizer:
         return color_map
     
     @staticmethod
-    def get_custom_instrinsic(resolution):
+    def get_custom_instrinsic(resolution, headless=False):
+        if headless:
+            return get_default_intrinsic(resolution)
+        
         vis = o3d.visualization.Visualizer()
         vis.create_window(
             width=resolution[0], 
@@ -36,80 +52,115 @@ class Visualizer:
         
         return intrinsic
 
-    def wrapup_scenes(self, sequence_of_scenes, voxel_size):
+    @staticmethod
+    def make_mosaic(images, resolution):
+        """
+        Tile images into one image of the given resolution, row by row on a near square grid.
+        Args:
+            images: List of HxWx3 uint8 images.
+            resolution: Mosaic (width, height).
+        Returns:
+            Mosaic image.
+        """
+        ncol = int(np.ceil(np.sqrt(len(images))))
+        nrow = int(np.ceil(len(images) / ncol))
+        tile_width, tile_height = resolution[0] // ncol, resolution[1] // nrow
+        
+        mosaic = np.full((resolution[1], resolution[0], 3), 255, dtype=np.uint8)
+        for i, image in enumerate(images):
+            row, col = divmod(i, ncol)
+            mosaic[row * tile_height:(row + 1) * tile_height, col * tile_width:(col + 1) * tile_width] = cv2.resize(
+                image, (tile_width, tile_height), interpolation=cv2.INTER_AREA
+            )
+        
+        return mosaic
+    
+    def get_output_names(self):
+        """
+        Output name of every stream, the configured one for a single view or a mosaic and one suffixed per view otherwise.
+        """
+        if self.mosaic or len(self.camera_views) == 1:
+            return {"mosaic": self.configs["output_name"]}
+        
+        stem, extension = osp.splitext(self.configs["output_name"])
+        
+        return {view: f"{stem}_{view}{extension}" for view in self.camera_views}
+    
+    def wrapup_scene(self, trajectory_element, voxel_size, frame_index=None):
+        with get_profiler().stage("wrapup", frame=frame_index, voxels_in=len(next(iter(trajectory_element.values())))):
+            return self.renderer.wrap(trajectory_element, voxel_size, frame_index=frame_index)
+    
+    def wrapup_scenes(self, sequence_of_scenes, voxel_size, frame_indices=None):
+        """
+        Wrap up a trajectory. frame_indices defaults to the position of every element.
+        """
         wraped_trajectory = []
         with tqdm(sequence_of_scenes, disable=not self.verbose) as pbar:
             pbar.set_description("Wrapping up scenes")
-            for trajectory_element in pbar:
-                # Wrap up to Open3D camera parameters
-                parameter = o3d.camera.PinholeCameraParameters()
-                
-                parameter.intrinsic = o3d.camera.PinholeCameraIntrinsic(
-                    width=self.configs["resolution"][0],
-                    height=self.configs["resolution"][1],
-                    intrinsic_matrix=trajectory_element["intrinsic"]
-                )
-                
-                parameter.extrinsic = np.copy(trajectory_element["extrinsic"])
-                
-                # Wrap up to Open3D geometry        
-                pcd = o3d.geometry.PointCloud()
-                pcd.points = o3d.utility.Vector3dVector(trajectory_element["coord"])
-                pcd.colors = o3d.utility.Vector3dVector(self.color_map[trajectory_element["label"]])
-                
-                voxel_grid = o3d.geometry.VoxelGrid.create_from_point_cloud(pcd, 0.95 * voxel_size)
-                
-                wraped_trajectory.append(
-                    {
-                        "voxel_grid": voxel_grid,
-                        "parameter": parameter    
-                    }
-                )
+            for frame_index, trajectory_element in zip(frame_indices or itertools.count(), pbar):
+                wraped_trajectory.append(self.wrapup_scene(trajectory_element, voxel_size, frame_index=frame_index))
                 
         return wraped_trajectory
     
-    def visualize(self, wraped_up_scenes, voxel_size):
-        vis = o3d.visualization.Visualizer()
-        vis.create_window(width=self.configs["resolution"][0], height=self.configs["resolution"][1])
-        # opt = vis.get_render_option()
-        # opt.background_color = np.asarray([0, 0, 0])
-        ctr = vis.get_view_control()
-        sequence_of_image = []
-        
-        # Video fream size
-        out = cv2.VideoWriter(
-            filename=osp.join(self.configs["output_path"], self.configs["output_name"]),
-            fourcc=cv2.VideoWriter_fourcc(*self.configs["output_codec"]), 
-            fps=self.configs["fps"],
-            frameSize=self.configs["resolution"]
-        )   
-        
-        # Render images from the scenes
-        with tqdm(wraped_up_scenes, disable=not self.verbose) as pbar:
-            pbar.set_description("Rendering scenes")
-            for scene in pbar:
-                # Load voxel grid
-                vis.clear_geometries()
-                vis.add_geometry(scene["voxel_grid"])
-                
-                # Set camera parameters
-                ctr.convert_from_pinhole_camera_parameters(
-                        scene["parameter"],
-                        allow_arbitrary=True
-                )
-                
-                vis.poll_events()
-                vis.update_renderer()
-                
-                image = vis.capture_screen_float_buffer(do_render=True)
-                image = (255 * np.asarray(image)).astype(np.uint8)
-                
-                sequence_of_image.append(image)
-                out.write(image)
-
-        vis.destroy_window()
-        out.release()
-        print(f"Video saved at {osp.join(self.configs['output_path'], self.configs['output_name'])}")
+    @staticmethod
+    def close_encoders(encoders):
+        """
+        Close every encoder, then raise the first error any of them hit.
+        """
+        exception = None
+        for encoder in encoders.values():
+            try:
+                encoder.close()
+            
+            except Exception as encoder_exception:
+                exception = exception or encoder_exception
+        
+        if exception is not None:
+            raise exception
+    
+    def visualize(self, wraped_up_scenes, voxel_size, total=None):
+        self.renderer.open()
+        
+        encoders = {}
+        try:
+            # Encode every output in a separate thread so that rendering and encoding overlap
+            output_names = self.get_output_names()
+            for view, output_name in output_names.items():
+                encoders[view] = AsyncEncoder(make_sink(self.configs, output_name), queue_size=self.configs.get("encoder_queue_size", 8))
+            
+            # Render images from the scenes
+            with tqdm(wraped_up_scenes, total=total, disable=not self.verbose) as pbar:
+                pbar.set_description("Rendering scenes")
+                for scene in pbar:
+                    images = self.renderer.render(scene)
+                    frame_index = scene.get("frame_index", None)
+                    
+                    if "mosaic" in encoders:
+                        if len(images) == 1:
+                            image = next(iter(images.values()))
+                        
+                        else:
+                            with get_profiler().stage("mosaic", frame=frame_index):
+                                image = Visualizer.make_mosaic([images[view] for view in self.camera_views], self.configs["resolution"])
+                        
+                        encoders["mosaic"].write(image, frame_index=frame_index)
+                    
+                    else:
+                        for view, encoder in encoders.items():
+                            encoder.write(images[view], frame_index=frame_index, view=view)
+        
+        finally:
+            # Also when rendering fails, so no encoder process is left running and every output is finalized
+            self.renderer.close()
+            Visualizer.close_encoders(encoders)
+        
+        for view, encoder in encoders.items():
+            print(encoder.sink.describe())
+        
+            if self.verbose:
+                stats = encoder.stats()
+                print(f"Encoded {stats['frames']} frames in {stats['encode_time']:.2f}s ({stats['encode_fps']:.1f} fps), "
+                      f"render loop stalled {stats['stalls']} times for {stats['stall_time']:.2f}s waiting on the encoder")
         
         return
         
\ No newline at end of file